@@ -0,0 +1,117 @@
+"""
+Compare full and reduced image decode used by the dhash module.
+
+Run as ``python _test/bench_dhash_decode.py [directory]``. Without directory,
+the images from the fun module are used. Every image is upscaled to
+``--size`` pixels and encoded as JPEG and PNG, to match the attachments
+that are usually posted.
+
+For both modes, the script reports decode time, the largest decoded image
+buffer and the Hamming distance between the reduced and full resolution
+hashes.
+"""
+
+import argparse
+import statistics
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from dhash_loader import ROOT, hashing
+from PIL import Image
+
+
+def load_corpus(directory: Path, size: int) -> List[Tuple[str, bytes]]:
+    corpus = []
+    for path in sorted(directory.rglob("*")):
+        if path.suffix.lower() not in (".png", ".jpg", ".jpeg", ".webp", ".gif"):
+            continue
+        image = Image.open(path).convert("RGB")
+        scale = size / max(image.size)
+        image = image.resize(
+            (round(image.width * scale), round(image.height * scale)),
+            Image.Resampling.BICUBIC,
+        )
+        for fmt in ("JPEG", "PNG"):
+            buffer = BytesIO()
+            image.save(buffer, format=fmt)
+            corpus.append((f"{path.name}.{fmt.lower()}", buffer.getvalue()))
+    return corpus
+
+
+def decoded_size(data: bytes, reduced: bool) -> int:
+    """Get size of the largest buffer allocated while decoding the image.
+
+    Pillow allocates its buffers outside of the Python allocator, so they
+    can't be measured by tracemalloc.
+    """
+    image = Image.open(BytesIO(data))
+    if reduced:
+        image.draft("L", (hashing.REDUCED_SIZE, hashing.REDUCED_SIZE))
+    image.load()
+    return image.width * image.height * len(image.getbands())
+
+
+def run(corpus: List[Tuple[str, bytes]], reduced: bool) -> Tuple[float, int, list]:
+    """Hash the corpus.
+
+    :return: Seconds spent, peak decoded buffer size in bytes and the hashes.
+    """
+    start = time.perf_counter()
+    hashes = [hashing.hash_image(data, reduced=reduced) for _, data in corpus]
+    seconds = time.perf_counter() - start
+    peak = max(decoded_size(data, reduced) for _, data in corpus)
+    return seconds, peak, hashes
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("directory", nargs="?", default=ROOT / "fun" / "data")
+    parser.add_argument("--size", type=int, default=3000, help="Image size")
+    parser.add_argument(
+        "--max-distance",
+        type=int,
+        default=5,
+        help="Largest allowed distance between reduced and full hash",
+    )
+    args = parser.parse_args()
+
+    corpus = load_corpus(Path(args.directory), args.size)
+    if not corpus:
+        print("No images found.")
+        return 1
+    megabytes = sum(len(data) for _, data in corpus) / 1024 / 1024
+    print(f"Corpus: {len(corpus)} images, {megabytes:.1f} MB")
+
+    results: Dict[Tuple[str, bool], Tuple[float, int, list]] = {}
+    worst: int = 0
+    for fmt in ("jpeg", "png"):
+        subset = [item for item in corpus if item[0].endswith(fmt)]
+        for reduced in (False, True):
+            results[(fmt, reduced)] = run(subset, reduced)
+            seconds, peak, _ = results[(fmt, reduced)]
+            print(
+                f"{fmt:>4} {'reduced' if reduced else 'full':>7}: "
+                f"{seconds / len(subset) * 1000:7.2f} ms per image, "
+                f"peak decoded buffer {peak / 1024 / 1024:.1f} MB"
+            )
+
+        distances = [
+            bin(full ^ reduced).count("1")
+            for full, reduced in zip(results[(fmt, False)][2], results[(fmt, True)][2])
+        ]
+        print(
+            f"{fmt:>4} Hamming distance: mean {statistics.mean(distances):.2f}, "
+            f"max {max(distances)}"
+        )
+        for (name, _), distance in zip(subset, distances):
+            if distance > args.max_distance:
+                print(f"  {name}: {distance}")
+        worst = max(worst, max(distances))
+    return 0 if worst <= args.max_distance else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
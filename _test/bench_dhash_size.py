@@ -0,0 +1,140 @@
+"""
+Compare lookup speed and matching accuracy of the dhash hash sizes.
+
+Run as ``python _test/bench_dhash_size.py [directory]``. Without directory,
+the images from the fun module are used. Every image is posted again as
+recompressed, downscaled and slightly cropped copy.
+
+For every hash size, the script reports:
+
+- recall, the fraction of the copies found within the repost threshold,
+- false-positive rate, the fraction of pairs of different images closer
+  than the threshold,
+- time of single index lookup, with the index filled with ``--rows`` random
+  hashes.
+"""
+
+import argparse
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+from dhash_loader import ROOT, hashing, index
+from PIL import Image
+
+
+def encode(image: Image.Image, fmt: str = "PNG", **params) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format=fmt, **params)
+    return buffer.getvalue()
+
+
+def recompress(image: Image.Image) -> bytes:
+    return encode(image, "JPEG", quality=60)
+
+
+def downscale(image: Image.Image) -> bytes:
+    return encode(image.resize((image.width // 2, image.height // 2)))
+
+
+def crop(image: Image.Image) -> bytes:
+    border = min(image.size) // 50
+    return encode(
+        image.crop((border, border, image.width - border, image.height - border))
+    )
+
+
+EDITS: Dict[str, Callable[[Image.Image], bytes]] = {
+    "recompress": recompress,
+    "downscale": downscale,
+    "crop": crop,
+}
+
+
+def load_corpus(directory: Path) -> List[Image.Image]:
+    corpus = []
+    for path in sorted(directory.rglob("*")):
+        if path.suffix.lower() not in (".png", ".jpg", ".jpeg", ".webp", ".gif"):
+            continue
+        corpus.append(Image.open(path).convert("RGB"))
+    return corpus
+
+
+def lookup_time(bits: int, radius: int, rows: int, queries: List[int]) -> float:
+    """Get average time of index lookup, in milliseconds."""
+    hash_index = index.HashIndex(bits=bits, radius=radius)
+    array = np.zeros(rows, dtype=index.snapshot_dtype(hash_index.words))
+    array["idx"] = array["message_id"] = np.arange(rows)
+    array["channel_id"] = 1
+    array["hash"] = np.random.default_rng(0).integers(
+        0, 2**64, size=(rows, hash_index.words), dtype=np.uint64, endpoint=False
+    )
+    # The most significant word is only partially used
+    array["hash"][:, 0] &= np.uint64((1 << (bits - 64 * (hash_index.words - 1))) - 1)
+    hash_index.extend_array(array)
+
+    start = time.perf_counter()
+    for value in queries:
+        hash_index.nearest(value)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("directory", nargs="?", default=ROOT / "fun" / "data")
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=14,
+        help="Repost threshold of 128 bit hashes, LIMIT_SOFT of the module",
+    )
+    parser.add_argument("--rows", type=int, default=100_000, help="Index size")
+    args = parser.parse_args()
+
+    corpus = load_corpus(Path(args.directory))
+    if len(corpus) < 2:
+        print("No images found.")
+        return 1
+    originals = [encode(image) for image in corpus]
+    copies = {name: [edit(image) for image in corpus] for name, edit in EDITS.items()}
+    pairs: int = len(corpus) * (len(corpus) - 1) // 2
+    print(f"Corpus: {len(corpus)} images, {len(EDITS)} edits, {pairs} pairs")
+    print(
+        "size  bits  limit  "
+        + "  ".join(f"{name:>10}" for name in EDITS)
+        + "  false-pos  lookup ms"
+    )
+
+    for hash_size in hashing.HASH_SIZES:
+        bits: int = hashing.get_bits(hash_size)
+        limit: int = hashing.scale_limit(args.limit, bits)
+        hashes = [hashing.hash_image(data, size=hash_size) for data in originals]
+
+        recall: List[float] = []
+        for name in EDITS:
+            found = [
+                bin(original ^ hashing.hash_image(data, size=hash_size)).count("1")
+                < limit
+                for original, data in zip(hashes, copies[name])
+            ]
+            recall.append(sum(found) / len(found))
+
+        false_positives = sum(
+            bin(a ^ b).count("1") < limit
+            for i, a in enumerate(hashes)
+            for b in hashes[i + 1 :]
+        )
+        milliseconds = lookup_time(bits, limit - 1, args.rows, hashes)
+        print(
+            f"{hash_size:>4}  {bits:>4}  {limit:>5}  "
+            + "  ".join(f"{value * 100:>9.1f}%" for value in recall)
+            + f"  {false_positives / pairs * 100:>8.2f}%  {milliseconds:>9.3f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,32 @@
+"""
+Import the dhash module of this repository for tests and benchmarks.
+
+The package is loaded by its path under different name, because the 'dhash'
+directory of this repository would shadow the dhash library it depends on.
+Use ``from dhash_loader import hashing, index``.
+"""
+
+import importlib.machinery
+import importlib.util
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+_spec = importlib.util.spec_from_file_location(
+    "dhash_module",
+    ROOT / "dhash" / "__init__.py",
+    submodule_search_locations=[str(ROOT / "dhash")],
+)
+sys.modules["dhash_module"] = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(sys.modules["dhash_module"])
+hashing = importlib.import_module("dhash_module.hashing")
+index = importlib.import_module("dhash_module.index")
+
+# With `PYTHONPATH=.`, the 'import dhash' in hashing.py gets this repository
+# as well, so the library is looked up outside of it.
+_library_spec = importlib.machinery.PathFinder.find_spec(
+    "dhash", [path for path in sys.path if Path(path or ".").resolve() != ROOT]
+)
+hashing.dhash = importlib.util.module_from_spec(_library_spec)
+_library_spec.loader.exec_module(hashing.dhash)
@@ -0,0 +1,61 @@
+try:
+    # Pure pytest, with `PYTHONPATH=.` as env var
+    from dhash.cache import TTLCache
+except ImportError:
+    # IDE, like PyCharm
+    from modules.fun.dhash.cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now: float = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class Test:
+    def test_expiration(self):
+        clock = Clock()
+        cache = TTLCache(maxsize=10, ttl=60, clock=clock)
+        cache["a"] = 1
+        cache.set("b", None, ttl=10)
+
+        assert "b" in cache
+        assert cache["b"] is None
+        clock.now = 30
+        assert "b" not in cache
+        assert cache.get("a") == 1
+        clock.now = 60
+        assert cache.get("a", "missing") == "missing"
+        assert len(cache) == 0
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(maxsize=2, ttl=60, clock=Clock())
+        cache["a"] = 1
+        cache["b"] = 2
+        assert cache["a"] == 1
+        cache["c"] = 3
+
+        assert "a" in cache
+        assert "b" not in cache
+        assert "c" in cache
+
+    def test_pop(self):
+        cache = TTLCache(maxsize=2, ttl=60, clock=Clock())
+        cache["a"] = 1
+
+        assert cache.pop("a") == 1
+        assert cache.pop("a", 0) == 0
+        assert len(cache) == 0
+
+    def test_memory_usage(self):
+        cache = TTLCache(maxsize=100, ttl=60, clock=Clock())
+        empty = cache.memory_usage()
+        for i in range(10):
+            cache[2**60 + i] = (2**61 + i, 2**62 + i)
+        full = cache.memory_usage()
+
+        assert full > empty
+        cache.clear()
+        assert cache.memory_usage() < full
@@ -0,0 +1,64 @@
+import random
+
+import numpy as np
+
+try:
+    # Pure pytest, with `PYTHONPATH=.` as env var
+    from dhash.cluster import find_clusters
+    from dhash.index import to_words
+except ImportError:
+    # IDE, like PyCharm
+    from modules.fun.dhash.cluster import find_clusters
+    from modules.fun.dhash.index import to_words
+
+RADIUS = 7
+"""Equal to LIMIT_HARD, which is used by the module"""
+
+
+def linear_clusters(values: list, radius: int) -> list:
+    labels = list(range(len(values)))
+
+    def root(i: int) -> int:
+        while labels[i] != i:
+            i = labels[i]
+        return i
+
+    for i in range(len(values)):
+        for j in range(i + 1, len(values)):
+            if bin(values[i] ^ values[j]).count("1") <= radius:
+                labels[root(j)] = root(i)
+
+    clusters = {}
+    for i in range(len(values)):
+        clusters.setdefault(root(i), []).append(i)
+    return sorted(sorted(c) for c in clusters.values() if len(c) > 1)
+
+
+class Test:
+    def values(self, count: int, bases: int, seed: int) -> list:
+        rng = random.Random(seed)
+        base = [rng.getrandbits(128) for _ in range(bases)]
+        result = []
+        for _ in range(count):
+            value = rng.choice(base)
+            for _ in range(rng.choice([0, 0, 2, 5, 30])):
+                value ^= 1 << rng.randrange(128)
+            result.append(value)
+        return result
+
+    def test_clusters_match_linear(self):
+        # The last one has buckets larger than SMALL_BUCKET
+        for seed, count, bases in ((0, 300, 15), (1, 600, 30), (2, 400, 3)):
+            values = self.values(count, bases, seed)
+            hashes = np.array([to_words(v, 2) for v in values], dtype=np.uint64)
+
+            clusters = find_clusters(hashes, 128, RADIUS)
+            assert [len(c) for c in clusters] == sorted(
+                (len(c) for c in clusters), reverse=True
+            )
+            assert sorted(sorted(c.tolist()) for c in clusters) == linear_clusters(
+                values, RADIUS
+            )
+
+    def test_empty(self):
+        assert find_clusters(np.zeros((0, 2), dtype=np.uint64), 128, RADIUS) == []
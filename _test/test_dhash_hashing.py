@@ -0,0 +1,75 @@
+import random
+from io import BytesIO
+
+import pytest
+from dhash_loader import hashing
+from PIL import Image, ImageDraw
+
+MAX_DISTANCE = 5
+"""Largest allowed distance of reduced and full hash, LIMIT_SOFT is 14."""
+
+
+def draw(seed: int, size=(2000, 1500)) -> Image.Image:
+    """Draw random shapes over gradient, like a large photo or screenshot."""
+    rng = random.Random(seed)
+    image = Image.linear_gradient("L").resize(size).convert("RGB")
+    canvas = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        box = (x, y, x + rng.randrange(100, 800), y + rng.randrange(100, 600))
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            canvas.rectangle(box, fill=color)
+        else:
+            canvas.ellipse(box, fill=color)
+    return image
+
+
+def encode(image: Image.Image, fmt: str) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class Test:
+    @pytest.mark.parametrize("fmt", ["JPEG", "PNG"])
+    def test_reduced_matches_full(self, fmt: str):
+        for seed in range(4):
+            data = encode(draw(seed), fmt)
+            reduced = hashing.hash_image(data, reduced=True)
+            full = hashing.hash_image(data, reduced=False)
+
+            assert reduced is not None
+            assert distance(reduced, full) <= MAX_DISTANCE
+
+    def test_hash_sizes(self):
+        data = encode(draw(0), "JPEG")
+        for size in hashing.HASH_SIZES:
+            bits = hashing.get_bits(size)
+            reduced = hashing.hash_image(data, reduced=True, size=size)
+            full = hashing.hash_image(data, reduced=False, size=size)
+
+            assert reduced < 2**bits
+            assert distance(reduced, full) <= hashing.scale_limit(MAX_DISTANCE, bits)
+
+    def test_different_images(self):
+        a = hashing.hash_image(encode(draw(0), "PNG"))
+        b = hashing.hash_image(encode(draw(1), "PNG"))
+
+        assert distance(a, b) > MAX_DISTANCE
+
+    def test_undecodable(self, monkeypatch):
+        data = encode(draw(0, size=(400, 300)), "PNG")
+
+        assert hashing.hash_image(b"not an image") is None
+        assert hashing.hash_image(data[: len(data) // 2], reduced=False) is None
+
+        # Over twice the limit, Pillow refuses to open the image
+        monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+        h, decode_s, hash_s = hashing.hash_image_timed(data)
+        assert h is None
+        assert hash_s == 0.0
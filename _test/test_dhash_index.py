@@ -0,0 +1,178 @@
+import random
+
+try:
+    # Pure pytest, with `PYTHONPATH=.` as env var
+    from dhash.index import HashIndex, IndexEntry, load_snapshot, save_snapshot
+except ImportError:
+    # IDE, like PyCharm
+    from modules.fun.dhash.index import (
+        HashIndex,
+        IndexEntry,
+        load_snapshot,
+        save_snapshot,
+    )
+
+RADIUS = 13
+"""Equal to LIMIT_SOFT - 1, which is used by the module"""
+
+
+class Test:
+    def entries(self, count: int, seed: int = 0) -> list:
+        rng = random.Random(seed)
+        base = [rng.getrandbits(128) for _ in range(count // 10)]
+        result = []
+        for i in range(count):
+            # Mostly near-duplicates of a few base images, with some noise
+            value = rng.choice(base)
+            for _ in range(rng.randint(0, 20)):
+                value ^= 1 << rng.randrange(128)
+            result.append(IndexEntry(i + 1, 1, 1000 + i // 2, value))
+        return result
+
+    def linear_scan(self, entries: list, value: int, message_id: int):
+        minimal_distance = 128
+        duplicate = None
+        for entry in entries:
+            if entry.message_id == message_id:
+                continue
+            distance = bin(entry.hash ^ value).count("1")
+            if distance < minimal_distance:
+                duplicate = entry
+                minimal_distance = distance
+        if minimal_distance > RADIUS:
+            return None
+        return duplicate, minimal_distance
+
+    def test_nearest_matches_linear_scan(self):
+        entries = self.entries(2000)
+        index = HashIndex(radius=RADIUS)
+        index.extend(entries)
+
+        for entry in entries[::7]:
+            expected = self.linear_scan(entries, entry.hash, entry.message_id)
+            assert index.nearest(entry.hash, entry.message_id) == expected
+
+    def test_remove_message(self):
+        entries = self.entries(200)
+        index = HashIndex(radius=RADIUS)
+        index.extend(entries)
+
+        assert index.remove_message(1000) == 2
+        assert index.remove_message(1000) == 0
+        assert len(index) == 198
+
+        remaining = [e for e in entries if e.message_id != 1000]
+        for entry in entries[:4]:
+            expected = self.linear_scan(remaining, entry.hash, None)
+            assert index.nearest(entry.hash) == expected
+
+    def test_exact_match(self):
+        index = HashIndex(radius=RADIUS)
+        index.add(IndexEntry(1, 1, 10, 0xABCDEF))
+        index.add(IndexEntry(2, 1, 11, 0xABCDEF))
+
+        assert index.nearest(0xABCDEF) == (IndexEntry(1, 1, 10, 0xABCDEF), 0)
+        assert index.nearest(0xABCDEF, exclude_message_id=10)[0].idx == 2
+        assert index.nearest(0xABCDEF ^ ((1 << RADIUS + 1) - 1)) is None
+
+    def test_scan_matches_nearest(self):
+        entries = self.entries(1000, seed=1)
+        index = HashIndex(radius=RADIUS)
+        index.extend(entries)
+        for message_id in range(1000, 1100):
+            index.remove_message(message_id)
+
+        for entry in entries[::5]:
+            assert index.scan(entry.hash, entry.message_id) == index.nearest(
+                entry.hash, entry.message_id
+            )
+
+    def test_channel_filter(self):
+        entries = [
+            IndexEntry(e.idx, 1 + e.idx % 3, e.message_id, e.hash)
+            for e in self.entries(1000, seed=2)
+        ]
+        index = HashIndex(radius=RADIUS)
+        index.extend(entries)
+
+        channel = [e for e in entries if e.channel_id == 2]
+        for entry in entries[::11]:
+            expected = self.linear_scan(channel, entry.hash, entry.message_id)
+            assert index.nearest(entry.hash, entry.message_id, [2]) == expected
+            assert index.nearest(
+                entry.hash, entry.message_id, [1, 2, 3]
+            ) == index.nearest(entry.hash, entry.message_id)
+
+    def test_remove_shrinks_arrays(self):
+        entries = self.entries(1000, seed=3)
+        index = HashIndex(radius=RADIUS)
+        index.extend(entries)
+
+        assert index.remove(e.idx for e in entries[:950]) == 950
+        assert index.remove([entries[0].idx]) == 0
+        assert len(index) == 50
+        assert len(index._rows) < 1000
+
+        for entry in entries[950::3]:
+            expected = self.linear_scan(entries[950:], entry.hash, entry.message_id)
+            assert index.nearest(entry.hash, entry.message_id) == expected
+
+    def test_add_after_remove(self):
+        entries = self.entries(3000, seed=6)
+        index = HashIndex(radius=RADIUS)
+        index.extend(entries[:2000])
+        index.remove(e.idx for e in entries[:1000])
+        index.add(entries[0])
+        index.add(entries[0])
+        index.extend(entries[2000:])
+
+        remaining = entries[:1] + entries[1000:]
+        assert len(index) == len(remaining)
+        for entry in entries[::29]:
+            expected = self.linear_scan(remaining, entry.hash, entry.message_id)
+            assert index.nearest(entry.hash, entry.message_id) == expected
+
+    def test_snapshot(self, tmp_path):
+        entries = self.entries(500, seed=4)
+        index = HashIndex(radius=RADIUS)
+        index.extend(entries[:400])
+        save_snapshot(tmp_path / "1.npy", index.to_array())
+
+        snapshot = load_snapshot(tmp_path / "1.npy", index.words)
+        assert load_snapshot(tmp_path / "1.npy", index.words + 1) is None
+        assert load_snapshot(tmp_path / "2.npy", index.words) is None
+
+        loaded = HashIndex(radius=RADIUS)
+        loaded.extend_array(snapshot)
+        loaded.extend(entries[300:])
+        index.extend(entries[400:])
+        assert len(loaded) == len(index) == 500
+        assert (loaded.to_array() == index.to_array()).all()
+
+        for entry in entries[::9]:
+            assert loaded.nearest(entry.hash, entry.message_id) == index.nearest(
+                entry.hash, entry.message_id
+            )
+
+    def test_search(self):
+        entries = self.entries(1000, seed=5)
+        index = HashIndex(radius=RADIUS)
+        index.extend(entries)
+
+        for entry in entries[::50]:
+            for radius in (RADIUS - 4, RADIUS, 40):
+                expected = sorted(
+                    (
+                        (e, bin(e.hash ^ entry.hash).count("1"))
+                        for e in entries
+                        if e.message_id != entry.message_id
+                    ),
+                    key=lambda result: (result[1], result[0].idx),
+                )
+                expected = [r for r in expected if r[1] <= radius][:5]
+                assert index.search(entry.hash, 5, radius, entry.message_id) == expected
+
+            nearest = index.nearest(entry.hash, entry.message_id)
+            assert index.search(entry.hash, 1, exclude_message_id=entry.message_id) == (
+                [nearest] if nearest else []
+            )
@@ -0,0 +1,68 @@
+import asyncio
+
+try:
+    # Pure pytest, with `PYTHONPATH=.` as env var
+    from dhash.scheduler import BACKFILL, LIVE, PrioritySlots
+except ImportError:
+    # IDE, like PyCharm
+    from modules.fun.dhash.scheduler import BACKFILL, LIVE, PrioritySlots
+
+
+async def _job(slots: PrioritySlots, lane: str, started: list, release: asyncio.Event):
+    await slots.acquire(lane)
+    started.append(lane)
+    try:
+        await release.wait()
+    finally:
+        slots.release(lane)
+
+
+class Test:
+    def test_backfill_is_limited(self):
+        async def main():
+            slots = PrioritySlots(size=3, backfill_size=1)
+            started, release = [], asyncio.Event()
+            jobs = [
+                asyncio.create_task(_job(slots, lane, started, release))
+                for lane in (BACKFILL, BACKFILL, LIVE, LIVE)
+            ]
+            await asyncio.sleep(0)
+
+            assert sorted(started) == [BACKFILL, LIVE, LIVE]
+            assert slots.waiting_in(BACKFILL) == 1
+            release.set()
+            await asyncio.gather(*jobs)
+            assert slots.running == 0
+
+        asyncio.run(main())
+
+    def test_live_goes_first(self):
+        async def main():
+            slots = PrioritySlots(size=1, backfill_size=1)
+            started, release = [], asyncio.Event()
+            first = asyncio.create_task(_job(slots, LIVE, started, release))
+            await asyncio.sleep(0)
+            jobs = [
+                asyncio.create_task(_job(slots, lane, started, asyncio.Event()))
+                for lane in (BACKFILL, LIVE)
+            ]
+            await asyncio.sleep(0)
+
+            assert slots.backlog
+            paused = asyncio.create_task(slots.wait_for_live())
+            await asyncio.sleep(0)
+            assert not paused.done()
+
+            release.set()
+            await first
+            await asyncio.sleep(0)
+            assert started == [LIVE, LIVE]
+            assert not slots.backlog
+            await paused
+            for job in jobs:
+                job.cancel()
+            await asyncio.gather(*jobs, return_exceptions=True)
+            assert slots.running == 0
+            assert slots.waiting == 0
+
+        asyncio.run(main())
@@ -0,0 +1,57 @@
+try:
+    # Pure pytest, with `PYTHONPATH=.` as env var
+    from dhash.stats import Histogram, Stats
+except ImportError:
+    # IDE, like PyCharm
+    from modules.fun.dhash.stats import Histogram, Stats
+
+
+class Clock:
+    def __init__(self):
+        self.now: float = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class Test:
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 2.0):
+            histogram.observe(value)
+
+        assert histogram.counts == [1, 2, 1]
+        assert histogram.mean == 0.7625
+        assert histogram.max == 2.0
+        assert 0.1 < histogram.quantile(0.5) <= 1.0
+        assert list(histogram.cumulative()) == [("0.1", 1), ("1.0", 3), ("+Inf", 4)]
+
+    def test_timer_and_counters(self):
+        clock = Clock()
+        stats = Stats(clock=clock)
+        with stats.timer("download", source="url"):
+            clock.now = 0.25
+        stats.count("cache_hits", cache="url")
+        stats.count("cache_hits", cache="url")
+
+        histogram = stats.get_histogram("download", source="url")
+        assert histogram.count == 1
+        assert histogram.sum == 0.25
+        assert stats.get_histogram("download") is None
+        assert stats.get_count("cache_hits", cache="url") == 2
+
+        stats.reset()
+        assert stats.get_count("cache_hits", cache="url") == 0
+
+    def test_export(self):
+        stats = Stats(clock=Clock())
+        stats.observe("hash", 0.002)
+        stats.count("bytes_downloaded", 1024, source="attachment")
+        text = stats.export({"index_hashes": {(("channel_id", "2"),): 10}})
+
+        assert "# TYPE dhash_stage_seconds histogram" in text
+        assert 'dhash_stage_seconds_bucket{stage="hash",le="0.0025"} 1' in text
+        assert 'dhash_stage_seconds_bucket{stage="hash",le="+Inf"} 1' in text
+        assert 'dhash_stage_seconds_count{stage="hash"} 1' in text
+        assert 'dhash_bytes_downloaded_total{source="attachment"} 1024' in text
+        assert 'dhash_index_hashes{channel_id="2"} 10' in text
@@ -0,0 +1,94 @@
+"""
+Bounded in-memory caches used by the dhash module.
+"""
+
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Mapping with limited size and limited age of its items.
+
+    When the cache is full, the least recently used item is dropped.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self._clock = clock
+        self._items: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._lookup(key) is not None
+
+    def __getitem__(self, key: Hashable) -> Any:
+        item = self._lookup(key)
+        if item is None:
+            raise KeyError(key)
+        return item[1]
+
+    def __setitem__(self, key: Hashable, value: Any):
+        self.set(key, value)
+
+    def _lookup(self, key: Hashable) -> Optional[Tuple[float, Any]]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if item[0] <= self._clock():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return item
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._lookup(key)
+        return default if item is None else item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store the value.
+
+        :param ttl: Lifetime of this item in seconds, if it should differ
+            from the cache default.
+        """
+        expires = self._clock() + (self.ttl if ttl is None else ttl)
+        self._items[key] = (expires, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._lookup(key)
+        if item is None:
+            return default
+        del self._items[key]
+        return item[1]
+
+    def clear(self):
+        self._items.clear()
+
+    def memory_usage(self) -> int:
+        """Estimate memory taken by the cache, in bytes.
+
+        Keys and values are measured including the items of tuples, which is
+        how this module stores its values.
+        """
+        total: int = sys.getsizeof(self._items)
+        for key, item in self._items.items():
+            total += _sizeof(key) + sys.getsizeof(item) + _sizeof(item[1])
+        return total
+
+
+def _sizeof(obj: Any) -> int:
+    if isinstance(obj, tuple):
+        return sys.getsizeof(obj) + sum(_sizeof(value) for value in obj)
+    return sys.getsizeof(obj)
@@ -0,0 +1,134 @@
+"""
+Grouping of stored hashes into clusters of near-duplicates.
+
+Two hashes belong to the same cluster if they are connected by a chain of
+hashes, each differing from the next one in at most ``radius`` bits.
+
+Comparing every pair of hashes is quadratic. As in HashIndex, the hashes are
+split into ``radius + 1`` chunks and only hashes sharing a chunk value are
+compared, because every close pair shares at least one of them.
+"""
+
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from .index import chunk_layout, chunk_values, popcount
+
+SMALL_BUCKET = 32
+"""Buckets up to this size are compared together, by pairing sorted rows."""
+BLOCK_SIZE = 256
+"""Rows of large bucket compared at once, to limit memory of the comparison."""
+
+
+def _bucket_edges(
+    hashes: np.ndarray, members: np.ndarray, radius: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Find pairs of rows in one large bucket closer than the radius."""
+    pairs_a: List[np.ndarray] = []
+    pairs_b: List[np.ndarray] = []
+    for start in range(0, len(members), BLOCK_SIZE):
+        block = members[start : start + BLOCK_SIZE]
+        # Each pair is compared once, with the rows from the block start on
+        others = members[start:]
+        xor = np.bitwise_xor(hashes[block][:, None, :], hashes[others][None, :, :])
+        distances = popcount(xor.reshape(-1, hashes.shape[1])).reshape(
+            len(block), len(others)
+        )
+        a, b = np.nonzero(distances <= radius)
+        keep = a < b
+        pairs_a.append(block[a[keep]])
+        pairs_b.append(others[b[keep]])
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+
+def _chunk_edges(
+    hashes: np.ndarray, keys: np.ndarray, radius: int
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """Find pairs of rows with the same chunk value closer than the radius."""
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    sizes = np.diff(np.r_[starts, len(keys)])
+    small = np.repeat(sizes <= SMALL_BUCKET, sizes)
+
+    edges_a: List[np.ndarray] = []
+    edges_b: List[np.ndarray] = []
+    # Rows of small buckets are paired with the rows up to SMALL_BUCKET
+    # positions after them in the sorted order, all at once
+    for step in range(1, min(SMALL_BUCKET, int(sizes.max()))):
+        same = (sorted_keys[step:] == sorted_keys[:-step]) & small[step:]
+        a, b = order[:-step][same], order[step:][same]
+        close = popcount(np.bitwise_xor(hashes[a], hashes[b])) <= radius
+        edges_a.append(a[close])
+        edges_b.append(b[close])
+
+    for start, size in zip(starts[sizes > SMALL_BUCKET], sizes[sizes > SMALL_BUCKET]):
+        a, b = _bucket_edges(hashes, order[start : start + size], radius)
+        edges_a.append(a)
+        edges_b.append(b)
+    return edges_a, edges_b
+
+
+def _components(size: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Label connected components of graph given by edge list.
+
+    :return: Label of each node, the lowest node of its component.
+    """
+    labels = np.arange(size)
+    while True:
+        lowest = np.minimum(labels[a], labels[b])
+        updated = labels.copy()
+        # Hook the roots of both trees as well, so long chains converge fast
+        for nodes in (a, b, labels[a], labels[b]):
+            np.minimum.at(updated, nodes, lowest)
+        # Point every node directly to the root of its tree
+        while True:
+            jumped = updated[updated]
+            if np.array_equal(jumped, updated):
+                break
+            updated = jumped
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def find_clusters(
+    hashes: np.ndarray,
+    bits: int,
+    radius: int,
+    progress: Optional[Callable[[float], None]] = None,
+) -> List[np.ndarray]:
+    """Group hashes into clusters of near-duplicates.
+
+    :param hashes: 2D array of hash words, see HashIndex.
+    :param progress: Called with the processed fraction, from 0 to 1.
+    :return: Row numbers of each cluster with at least two rows, the largest
+        cluster first.
+    """
+    if not len(hashes):
+        return []
+
+    # Byte-identical images are common, they are compared only once
+    unique, inverse = np.unique(hashes, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    chunks = list(chunk_values(unique, chunk_layout(bits, radius)))
+    edges_a: List[np.ndarray] = []
+    edges_b: List[np.ndarray] = []
+    for i, keys in enumerate(chunks):
+        a, b = _chunk_edges(unique, keys, radius)
+        edges_a += a
+        edges_b += b
+        if progress is not None:
+            progress((i + 1) / len(chunks))
+
+    a = np.concatenate(edges_a) if edges_a else np.zeros(0, dtype=np.int64)
+    b = np.concatenate(edges_b) if edges_b else np.zeros(0, dtype=np.int64)
+    labels = _components(len(unique), a, b)[inverse]
+
+    order = np.argsort(labels, kind="stable")
+    bounds = np.flatnonzero(labels[order][1:] != labels[order][:-1]) + 1
+    clusters = [rows for rows in np.split(order, bounds) if len(rows) > 1]
+    clusters.sort(key=len, reverse=True)
+    return clusters
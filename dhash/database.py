@@ -1,11 +1,47 @@
 from __future__ import annotations
 
-from typing import Dict, List, Optional, Union
-
-from sqlalchemy import BigInteger, Column, Integer, String, UniqueConstraint
+import shutil
+from functools import partial
+from pathlib import Path
+from typing import Callable, Collection, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    UniqueConstraint,
+    bindparam,
+    func,
+    inspect,
+    or_,
+    text,
+)
+from sqlalchemy.orm import Session
 
 from pie.database import database, session
 
+from .index import (
+    HashIndex,
+    IndexEntry,
+    load_snapshot,
+    pack,
+    snapshot_dtype,
+    snapshot_entry,
+    unpack,
+)
+
+SNAPSHOT_DIR = Path("data") / "dhash"
+"""Directory of index snapshots, relative to the working directory of the bot.
+
+It holds guild, channel and message IDs, so it is kept outside of the module.
+"""
+LEGACY_SNAPSHOT_DIR = Path(__file__).parent / "snapshots"
+"""Directory of snapshots written by older versions, see move_snapshots()."""
+
 
 class ImageHash(database.base):
     """Stored image hashes"""
@@ -17,11 +53,28 @@ class ImageHash(database.base):
     channel_id = Column(BigInteger)
     message_id = Column(BigInteger)
     attachment_id = Column(BigInteger)
-    hash = Column(String)
+    packed_hash = Column(LargeBinary)
+
+    __table_args__ = (
+        Index("ix_fun_dhash_images_channel", guild_id, channel_id, message_id),
+        Index("ix_fun_dhash_images_message", guild_id, message_id),
+        Index("ix_fun_dhash_images_attachment", guild_id, attachment_id),
+    )
+
+    # Lazily built lookup indices by guild ID and hash bits, see get_index()
+    _indexes: Dict[Tuple[int, int], HashIndex] = {}
+    # Changes made while the index is loaded outside of the event loop, see
+    # begin_load()
+    _pending: Dict[Tuple[int, int], List[Callable[[HashIndex], object]]] = {}
 
     @staticmethod
     def add(
-        guild_id: int, channel_id: int, message_id: int, attachment_id: int, hash: str
+        guild_id: int,
+        channel_id: int,
+        message_id: int,
+        attachment_id: int,
+        hash: int,
+        bits: int = 128,
     ) -> ImageHash:
         """Add new image hash"""
         image = ImageHash.get_by_attachment(
@@ -35,21 +88,236 @@ class ImageHash(database.base):
             channel_id=channel_id,
             message_id=message_id,
             attachment_id=attachment_id,
-            hash=hash,
+            packed_hash=pack(hash, bits),
         )
 
         session.add(image)
         session.commit()
 
+        ImageHash._update_indexes(
+            guild_id, bits, partial(HashIndex.add, entry=image.to_entry())
+        )
+
         return image
 
     @staticmethod
-    def get_hash(guild_id: int, channel_id: int, hash: str):
-        return (
-            session.query(ImageHash)
-            .filter_by(guild_id=guild_id, channel_id=channel_id, hash=hash)
+    def add_bulk(images: List[dict]) -> List[ImageHash]:
+        """Add multiple image hashes in single transaction.
+
+        :param images: Dictionaries with the same keys as add() arguments.
+            The ``bits`` key is optional.
+        :return: Added images. Already known attachments are skipped.
+        """
+        known = set()
+        for guild_id in {image["guild_id"] for image in images}:
+            query = session.query(ImageHash.attachment_id).filter(
+                ImageHash.guild_id == guild_id,
+                ImageHash.attachment_id.in_(
+                    [i["attachment_id"] for i in images if i["guild_id"] == guild_id]
+                ),
+            )
+            known.update((guild_id, attachment_id) for (attachment_id,) in query)
+
+        result: List[ImageHash] = []
+        for image in images:
+            key = (image["guild_id"], image["attachment_id"])
+            if key in known:
+                continue
+            known.add(key)
+            result.append(
+                ImageHash(
+                    guild_id=image["guild_id"],
+                    channel_id=image["channel_id"],
+                    message_id=image["message_id"],
+                    attachment_id=image["attachment_id"],
+                    packed_hash=pack(image["hash"], image.get("bits", 128)),
+                )
+            )
+
+        session.add_all(result)
+        session.commit()
+
+        for image in result:
+            ImageHash._update_indexes(
+                image.guild_id,
+                image.bits,
+                partial(HashIndex.add, entry=image.to_entry()),
+            )
+
+        return result
+
+    @staticmethod
+    def get_index(guild_id: int, radius: int, bits: int = 128) -> HashIndex:
+        """Get in-memory index of guild hashes of given size.
+
+        Single index holds all channels of the guild, lookups limited to some
+        channels filter the results by channel ID.
+
+        The index is loaded on first use, unless it has been loaded in the
+        background already, see begin_load(). Then it is kept up to date by
+        add() and delete_by_messages().
+        """
+        index = ImageHash._indexes.get((guild_id, bits))
+        if index is None:
+            index = ImageHash.load_index(guild_id, radius, bits)
+            ImageHash._indexes[(guild_id, bits)] = index
+        return index
+
+    @staticmethod
+    def is_index_loaded(guild_id: int, bits: int) -> bool:
+        return (guild_id, bits) in ImageHash._indexes
+
+    @staticmethod
+    def begin_load(guild_id: int, bits: int):
+        """Start recording changes of index loaded by load_index() in thread.
+
+        The changes made after the load has read the database are replayed
+        by finish_load(). Replaying changes the load has already seen is
+        no-op.
+        """
+        ImageHash._pending[(guild_id, bits)] = []
+
+    @staticmethod
+    def finish_load(guild_id: int, bits: int, index: Optional[HashIndex]):
+        """Apply changes recorded since begin_load() and start using the index.
+
+        :param index: The loaded index, or None if the load failed.
+        """
+        updates = ImageHash._pending.pop((guild_id, bits), [])
+        if index is None or (guild_id, bits) in ImageHash._indexes:
+            return
+        for update in updates:
+            update(index)
+        ImageHash._indexes[(guild_id, bits)] = index
+
+    @staticmethod
+    def load_index(guild_id: int, radius: int, bits: int = 128) -> HashIndex:
+        """Build index from the snapshot written by get_snapshots(), if it is
+        still valid, and from the database.
+
+        It uses its own database session and does not touch the loaded
+        indices, so it can run in a thread.
+        """
+        with Session(database.db) as db_session:
+            return ImageHash._load_index(db_session, guild_id, radius, bits)
+
+    @staticmethod
+    def _load_index(
+        session: Session, guild_id: int, radius: int, bits: int
+    ) -> HashIndex:
+        index = HashIndex(bits=bits, radius=radius)
+        size: int = -(-bits // 8)
+        watermark: int = 0
+        snapshot = load_snapshot(
+            ImageHash.get_snapshot_path(guild_id, bits), index.words
+        )
+        if snapshot is not None and len(snapshot):
+            # Rows up to the watermark must not have changed since the snapshot
+            # was written. They can only be deleted, so it is enough to count
+            # them. The last row is compared as well, in case the table was
+            # recreated since then.
+            last = snapshot_entry(snapshot[-1])
+            stored = session.get(ImageHash, last.idx)
+            count = (
+                session.query(ImageHash)
+                .filter(
+                    ImageHash.guild_id == guild_id,
+                    ImageHash.idx <= last.idx,
+                    func.length(ImageHash.packed_hash) == size,
+                )
+                .count()
+            )
+            if (
+                stored is not None
+                and stored.guild_id == guild_id
+                and stored.bits == bits
+                and stored.to_entry() == last
+                and count == len(snapshot)
+            ):
+                index.extend_array(snapshot)
+                watermark = last.idx
+
+        rows = (
+            session.query(
+                ImageHash.idx,
+                ImageHash.channel_id,
+                ImageHash.message_id,
+                ImageHash.packed_hash,
+            )
+            .filter(
+                ImageHash.guild_id == guild_id,
+                ImageHash.idx > watermark,
+                func.length(ImageHash.packed_hash) == size,
+            )
             .all()
         )
+        array = np.empty(len(rows), dtype=snapshot_dtype(index.words))
+        if rows:
+            idx, channel_ids, message_ids, hashes = zip(*rows)
+            array["idx"] = idx
+            array["channel_id"] = channel_ids
+            array["message_id"] = message_ids
+            # Big-endian hashes padded to whole 64bit words
+            padded = b"".join(value.rjust(index.words * 8, b"\0") for value in hashes)
+            array["hash"] = (
+                np.frombuffer(padded, dtype=">u8")
+                .reshape(len(rows), index.words)
+                .astype(np.uint64)
+            )
+        index.extend_array(array)
+        return index
+
+    @staticmethod
+    def get_snapshot_path(guild_id: int, bits: int) -> Path:
+        return SNAPSHOT_DIR / f"{guild_id}-{bits}.npy"
+
+    @staticmethod
+    def drop_indexes(guild_id: int, used_bits: Collection[int]):
+        """Unload guild indices of hash sizes the guild does not use anymore,
+        and delete their snapshots.
+
+        :param used_bits: Hash sizes of the guild hash channels.
+        """
+        for key in list(ImageHash._indexes):
+            if key[0] == guild_id and key[1] not in used_bits:
+                del ImageHash._indexes[key]
+        for path in SNAPSHOT_DIR.glob(f"{guild_id}-*.npy"):
+            if int(path.stem.split("-")[1]) not in used_bits:
+                path.unlink(missing_ok=True)
+
+    @staticmethod
+    def move_snapshots():
+        """Move snapshots older versions wrote into the module directory."""
+        if not LEGACY_SNAPSHOT_DIR.is_dir():
+            return
+        SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+        for path in LEGACY_SNAPSHOT_DIR.glob("*.npy"):
+            shutil.move(path, SNAPSHOT_DIR / path.name)
+        try:
+            LEGACY_SNAPSHOT_DIR.rmdir()
+        except OSError:
+            # Something else is there, leave it
+            pass
+
+    @staticmethod
+    def get_snapshots() -> Dict[Path, np.ndarray]:
+        """Get contents of loaded indices, to be written by save_snapshot()."""
+        return {
+            ImageHash.get_snapshot_path(guild_id, bits): index.to_array()
+            for (guild_id, bits), index in ImageHash._indexes.items()
+        }
+
+    @staticmethod
+    def get_index_sizes() -> Dict[Tuple[int, int, int], int]:
+        """Get number of hashes of each channel in the loaded indices.
+
+        :return: Mapping of (guild ID, channel ID, hash bits) to the count.
+        """
+        return {
+            (guild_id, channel_id, bits): count
+            for (guild_id, bits), index in ImageHash._indexes.items()
+            for channel_id, count in index.channel_sizes().items()
+        }
 
     @staticmethod
     def get_by_channel(guild_id: int, channel_id: int):
@@ -77,20 +345,165 @@ class ImageHash(database.base):
         )
 
     @staticmethod
-    def delete_by_message(guild_id: int, message_id: int):
-        image = (
-            session.query(ImageHash)
-            .filter_by(guild_id=guild_id, message_id=message_id)
-            .delete()
+    def delete_by_message(guild_id: int, message_id: int) -> int:
+        return ImageHash.delete_by_messages(guild_id, [message_id])
+
+    @staticmethod
+    def delete_by_messages(
+        guild_id: int, message_ids: List[int], batch: int = 500
+    ) -> int:
+        """Delete hashes of multiple messages in single transaction.
+
+        :param batch: Maximal number of message IDs in one DELETE statement.
+        :return: Number of deleted rows.
+        """
+        deleted: int = 0
+        for start in range(0, len(message_ids), batch):
+            deleted += (
+                session.query(ImageHash)
+                .filter(
+                    ImageHash.guild_id == guild_id,
+                    ImageHash.message_id.in_(message_ids[start : start + batch]),
+                )
+                .delete(synchronize_session=False)
+            )
+        session.commit()
+
+        ImageHash._update_indexes(
+            guild_id, None, partial(HashIndex.remove_messages, message_ids=message_ids)
+        )
+
+        return deleted
+
+    @staticmethod
+    def prune(
+        guild_id: int,
+        channel_id: int,
+        before_message_id: Optional[int] = None,
+        limit: int = 1000,
+    ) -> int:
+        """Delete batch of channel hashes, and remove them from the index.
+
+        :param before_message_id: Only delete hashes of messages older than
+            this snowflake. All hashes of the channel are deleted if None.
+        :param limit: Maximal number of deleted rows.
+        :return: Number of deleted rows. Less than limit means there is
+            nothing left to delete.
+        """
+        query = session.query(ImageHash.idx).filter_by(
+            guild_id=guild_id, channel_id=channel_id
+        )
+        if before_message_id is not None:
+            query = query.filter(ImageHash.message_id < before_message_id)
+        indices = [idx for (idx,) in query.limit(limit)]
+        if not indices:
+            return 0
+
+        session.query(ImageHash).filter(ImageHash.idx.in_(indices)).delete(
+            synchronize_session=False
         )
         session.commit()
-        return image
+
+        ImageHash._update_indexes(
+            guild_id, None, partial(HashIndex.remove, indices=indices)
+        )
+
+        return len(indices)
+
+    @staticmethod
+    def _update_indexes(
+        guild_id: int, bits: Optional[int], update: Callable[[HashIndex], object]
+    ):
+        """Apply change to the guild indices, including the ones being loaded.
+
+        :param bits: Hash size of the indices to update, all if None.
+        """
+        for (index_guild_id, index_bits), index in ImageHash._indexes.items():
+            if index_guild_id == guild_id and bits in (None, index_bits):
+                update(index)
+        for (index_guild_id, index_bits), updates in ImageHash._pending.items():
+            if index_guild_id == guild_id and bits in (None, index_bits):
+                updates.append(update)
+
+    @property
+    def hash(self) -> int:
+        return unpack(self.packed_hash)
+
+    @property
+    def bits(self) -> int:
+        return len(self.packed_hash) * 8
+
+    def to_entry(self) -> IndexEntry:
+        return IndexEntry(
+            idx=self.idx,
+            channel_id=self.channel_id,
+            message_id=self.message_id,
+            hash=self.hash,
+        )
+
+    @staticmethod
+    def migrate() -> int:
+        """Convert table created by older versions of the module.
+
+        Hashes used to be stored as hex strings in the ``hash`` column, which
+        had to be parsed on every comparison, and the table had no indices.
+
+        :return: Number of converted rows.
+        """
+        table = ImageHash.__table__
+        bind = session.get_bind()
+        inspector = inspect(bind)
+        if not inspector.has_table(table.name):
+            # The table will be created by the bot in the current format
+            return 0
+
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        if "packed_hash" not in columns:
+            column_type = table.c.packed_hash.type.compile(dialect=bind.dialect)
+            session.execute(
+                text(f"ALTER TABLE {table.name} ADD COLUMN packed_hash {column_type}")
+            )
+        for index in table.indexes:
+            index.create(session.connection(), checkfirst=True)
+        # Hashes are looked up by the in-memory index, this one served no query
+        if "ix_fun_dhash_images_hash" in {
+            index["name"] for index in inspector.get_indexes(table.name)
+        }:
+            Index("ix_fun_dhash_images_hash", table.c.guild_id).drop(
+                session.connection()
+            )
+
+        converted: int = 0
+        if "hash" in columns:
+            rows = session.execute(
+                text(
+                    f"SELECT idx, hash FROM {table.name} "
+                    "WHERE packed_hash IS NULL AND hash IS NOT NULL"
+                )
+            ).all()
+            update = (
+                table.update()
+                .where(table.c.idx == bindparam("row_idx"))
+                .values(packed_hash=bindparam("row_hash"))
+            )
+            for start in range(0, len(rows), 1000):
+                session.execute(
+                    update,
+                    [
+                        {"row_idx": idx, "row_hash": pack(int(value, 16))}
+                        for idx, value in rows[start : start + 1000]
+                    ],
+                )
+            converted = len(rows)
+
+        session.commit()
+        return converted
 
     def __repr__(self) -> str:
         return (
             f'<{self.__class__.__name__} idx="{self.idx}" guild_id="{self.guild_id}" '
             f'channel_id="{self.channel_id}" message_id="{self.message_id}" '
-            f'attachement_id="{self.attachment_id}" hash="{self.hash}">'
+            f'attachement_id="{self.attachment_id}" hash="{self.hash:x}">'
         )
 
     def dump(self) -> dict:
@@ -99,7 +512,134 @@ class ImageHash(database.base):
             "channel_id": self.channel_id,
             "message_id": self.message_id,
             "attachment_id": self.attachment_id,
-            "hash": self.hash,
+            "hash": self.packed_hash.hex(),
+        }
+
+
+class ImageDigest(database.base):
+    """Hashes of images by digest of their file content.
+
+    Byte-identical files can reuse the hash without being decoded again.
+
+    The digest remembers the message it was first computed for, so it is
+    pruned together with the hashes of the channel.
+    """
+
+    __tablename__ = "fun_dhash_digests"
+
+    digest = Column(LargeBinary, primary_key=True)
+    packed_hash = Column(LargeBinary, nullable=False)
+    guild_id = Column(BigInteger)
+    channel_id = Column(BigInteger)
+    message_id = Column(BigInteger)
+
+    __table_args__ = (
+        Index("ix_fun_dhash_digests_message", guild_id, channel_id, message_id),
+    )
+
+    @staticmethod
+    def add(
+        digest: bytes,
+        hash: int,
+        guild_id: int,
+        channel_id: int,
+        message_id: int,
+        commit: bool = True,
+        bits: int = 128,
+    ) -> ImageDigest:
+        """Add new digest.
+
+        :param message_id: The message with the image.
+        :param commit: Whether to commit the session. Bulk inserts may leave
+            it to ImageHash.add_bulk().
+        :param bits: Size of the hash.
+        """
+        image = session.get(ImageDigest, digest)
+        if image is not None:
+            return image
+
+        image = ImageDigest(
+            digest=digest,
+            packed_hash=pack(hash, bits),
+            guild_id=guild_id,
+            channel_id=channel_id,
+            message_id=message_id,
+        )
+        session.add(image)
+        if commit:
+            session.commit()
+        return image
+
+    @staticmethod
+    def get(digest: bytes) -> Optional[int]:
+        """Get hash of the image with given digest."""
+        image = session.get(ImageDigest, digest)
+        return unpack(image.packed_hash) if image is not None else None
+
+    @staticmethod
+    def prune(
+        guild_id: int,
+        channel_id: int,
+        before_message_id: Optional[int] = None,
+        limit: int = 1000,
+    ) -> int:
+        """Delete batch of channel digests, see ImageHash.prune().
+
+        :return: Number of deleted rows.
+        """
+        query = session.query(ImageDigest.digest).filter_by(
+            guild_id=guild_id, channel_id=channel_id
+        )
+        if before_message_id is not None:
+            query = query.filter(ImageDigest.message_id < before_message_id)
+        digests = [digest for (digest,) in query.limit(limit)]
+        if not digests:
+            return 0
+
+        session.query(ImageDigest).filter(ImageDigest.digest.in_(digests)).delete(
+            synchronize_session=False
+        )
+        session.commit()
+        return len(digests)
+
+    @staticmethod
+    def migrate():
+        """Add message columns introduced by newer versions of the module.
+
+        Older digests don't know their message, so they could never be
+        pruned. They are deleted, the images are hashed again when needed.
+        """
+        table = ImageDigest.__table__
+        bind = session.get_bind()
+        inspector = inspect(bind)
+        if not inspector.has_table(table.name):
+            return
+
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        if "message_id" not in columns:
+            session.execute(text(f"DELETE FROM {table.name}"))
+            for name in ("guild_id", "channel_id", "message_id"):
+                column_type = table.c[name].type.compile(dialect=bind.dialect)
+                session.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {name} {column_type}")
+                )
+        for index in table.indexes:
+            index.create(session.connection(), checkfirst=True)
+        session.commit()
+
+    def __repr__(self) -> str:
+        return (
+            f'<{self.__class__.__name__} digest="{self.digest.hex()}" '
+            f'hash="{self.packed_hash.hex()}" message_id="{self.message_id}">'
+        )
+
+    def dump(self) -> dict:
+        return {
+            "digest": self.digest.hex(),
+            "hash": self.packed_hash.hex(),
+            "guild_id": self.guild_id,
+            "channel_id": self.channel_id,
+            "message_id": self.message_id,
         }
 
 
@@ -166,6 +706,13 @@ class HashChannel(database.base):
     guild_id = Column(BigInteger, nullable=False)
     channel_id = Column(BigInteger, nullable=False)
     reaction_limit = Column(Integer, nullable=False)
+    # 'channel' to detect reposts within the channel, 'guild' to detect them
+    # across all hash channels of the guild
+    scope = Column(String, nullable=False, default="channel", server_default="channel")
+    # Hashes of messages older than this are deleted, None keeps them forever
+    retention_days = Column(Integer)
+    # Size of the dhash grid, the hashes have 2 * hash_size ** 2 bits
+    hash_size = Column(Integer, nullable=False, default=8, server_default="8")
 
     __table_args__ = (UniqueConstraint(guild_id, channel_id),)
 
@@ -188,6 +735,21 @@ class HashChannel(database.base):
 
         session.commit()
 
+    def set_scope(self, scope: str):
+        self.scope = scope
+
+        session.commit()
+
+    def set_retention(self, retention_days: Optional[int]):
+        self.retention_days = retention_days
+
+        session.commit()
+
+    def set_hash_size(self, hash_size: int):
+        self.hash_size = hash_size
+
+        session.commit()
+
     @staticmethod
     def get(guild_id: int, channel_id: int) -> Optional[HashChannel]:
         query = (
@@ -198,9 +760,12 @@ class HashChannel(database.base):
         return query
 
     @staticmethod
-    def get_all(guild_id: int) -> List[HashChannel]:
-        query = session.query(HashChannel).filter_by(guild_id=guild_id).all()
-        return query
+    def get_all(guild_id: Optional[int]) -> List[HashChannel]:
+        """Get hash channels of the guild, or of all guilds if it is None."""
+        query = session.query(HashChannel)
+        if guild_id is not None:
+            query = query.filter_by(guild_id=guild_id)
+        return query.all()
 
     @staticmethod
     def remove(guild_id: int, channel_id: int):
@@ -212,14 +777,239 @@ class HashChannel(database.base):
         session.commit()
         return query
 
+    @staticmethod
+    def migrate():
+        """Add columns introduced by newer versions of the module."""
+        table = HashChannel.__table__
+        bind = session.get_bind()
+        inspector = inspect(bind)
+        if not inspector.has_table(table.name):
+            return
+
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        if "scope" not in columns:
+            column_type = table.c.scope.type.compile(dialect=bind.dialect)
+            session.execute(
+                text(
+                    f"ALTER TABLE {table.name} ADD COLUMN scope {column_type} "
+                    "NOT NULL DEFAULT 'channel'"
+                )
+            )
+        if "retention_days" not in columns:
+            column_type = table.c.retention_days.type.compile(dialect=bind.dialect)
+            session.execute(
+                text(
+                    f"ALTER TABLE {table.name} ADD COLUMN retention_days {column_type}"
+                )
+            )
+        if "hash_size" not in columns:
+            column_type = table.c.hash_size.type.compile(dialect=bind.dialect)
+            session.execute(
+                text(
+                    f"ALTER TABLE {table.name} ADD COLUMN hash_size {column_type} "
+                    "NOT NULL DEFAULT 8"
+                )
+            )
+        session.commit()
+
+    def __repr__(self) -> str:
+        return (
+            f'<{self.__class__.__name__} idx="{self.idx}" '
+            f'guild_id="{self.guild_id}" channel_id="{self.channel_id}" '
+            f'scope="{self.scope}">'
+        )
+
+    def dump(self) -> Dict[str, Union[int, str, None]]:
+        return {
+            "guild_id": self.guild_id,
+            "channel_id": self.channel_id,
+            "reaction_limit": self.reaction_limit,
+            "scope": self.scope,
+            "retention_days": self.retention_days,
+            "hash_size": self.hash_size,
+        }
+
+
+class HashCheckpoint(database.base):
+    """Progress of channel history scan.
+
+    History is scanned from the newest message, so ``last_message_id`` is the
+    oldest message processed by unfinished scan. ``completed_id`` is the newest
+    message covered by a scan that has been completed.
+    """
+
+    __tablename__ = "fun_dhash_checkpoints"
+
+    idx = Column(Integer, primary_key=True, autoincrement=True)
+    guild_id = Column(BigInteger, nullable=False)
+    channel_id = Column(BigInteger, nullable=False)
+    scan_start_id = Column(BigInteger)
+    last_message_id = Column(BigInteger)
+    completed_id = Column(BigInteger)
+
+    __table_args__ = (UniqueConstraint(guild_id, channel_id),)
+
+    @staticmethod
+    def get(guild_id: int, channel_id: int) -> HashCheckpoint:
+        """Get checkpoint of channel. It is created if it does not exist yet."""
+        checkpoint = (
+            session.query(HashCheckpoint)
+            .filter_by(guild_id=guild_id, channel_id=channel_id)
+            .one_or_none()
+        )
+        if checkpoint is None:
+            checkpoint = HashCheckpoint(guild_id=guild_id, channel_id=channel_id)
+            session.add(checkpoint)
+            session.commit()
+        return checkpoint
+
+    def save(self):
+        session.commit()
+
+    @staticmethod
+    def remove(guild_id: int, channel_id: int) -> int:
+        query = (
+            session.query(HashCheckpoint)
+            .filter_by(guild_id=guild_id, channel_id=channel_id)
+            .delete()
+        )
+        session.commit()
+        return query
+
+    def __repr__(self) -> str:
+        return (
+            f'<{self.__class__.__name__} idx="{self.idx}" '
+            f'guild_id="{self.guild_id}" channel_id="{self.channel_id}" '
+            f'scan_start_id="{self.scan_start_id}" '
+            f'last_message_id="{self.last_message_id}" '
+            f'completed_id="{self.completed_id}">'
+        )
+
+    def dump(self) -> Dict[str, Optional[int]]:
+        return {
+            "guild_id": self.guild_id,
+            "channel_id": self.channel_id,
+            "scan_start_id": self.scan_start_id,
+            "last_message_id": self.last_message_id,
+            "completed_id": self.completed_id,
+        }
+
+
+class RepostReport(database.base):
+    """Mapping of repost messages to reports about them."""
+
+    __tablename__ = "fun_dhash_reports"
+
+    idx = Column(Integer, primary_key=True, autoincrement=True)
+    guild_id = Column(BigInteger, nullable=False)
+    channel_id = Column(BigInteger, nullable=False)
+    message_id = Column(BigInteger, nullable=False)
+    report_id = Column(BigInteger, nullable=False)
+
+    __table_args__ = (
+        Index("ix_fun_dhash_reports_message", guild_id, message_id),
+        Index("ix_fun_dhash_reports_report", guild_id, report_id),
+    )
+
+    @staticmethod
+    def add(
+        guild_id: int, channel_id: int, message_id: int, report_id: int
+    ) -> RepostReport:
+        """Add new report.
+
+        :param channel_id: Channel of the report.
+        :param message_id: The repost message.
+        :param report_id: The report message.
+        """
+        report = RepostReport(
+            guild_id=guild_id,
+            channel_id=channel_id,
+            message_id=message_id,
+            report_id=report_id,
+        )
+        session.add(report)
+        session.commit()
+        return report
+
+    @staticmethod
+    def get_by_report(guild_id: int, report_id: int) -> Optional[RepostReport]:
+        return (
+            session.query(RepostReport)
+            .filter_by(guild_id=guild_id, report_id=report_id)
+            .one_or_none()
+        )
+
+    @staticmethod
+    def remove(guild_id: int, message_id: int) -> List[RepostReport]:
+        """Remove reports of deleted message, or the report if it was deleted.
+
+        :return: The removed reports.
+        """
+        return RepostReport.remove_bulk(guild_id, [message_id])
+
+    @staticmethod
+    def remove_bulk(
+        guild_id: int, message_ids: List[int], batch: int = 500
+    ) -> List[RepostReport]:
+        """Remove reports of deleted messages, and the deleted reports.
+
+        :param batch: Maximal number of message IDs in one query.
+        :return: The removed reports.
+        """
+        reports: List[RepostReport] = []
+        for start in range(0, len(message_ids), batch):
+            chunk = message_ids[start : start + batch]
+            reports += (
+                session.query(RepostReport)
+                .filter(
+                    RepostReport.guild_id == guild_id,
+                    or_(
+                        RepostReport.message_id.in_(chunk),
+                        RepostReport.report_id.in_(chunk),
+                    ),
+                )
+                .all()
+            )
+        for report in reports:
+            session.delete(report)
+        session.commit()
+        return reports
+
+    @staticmethod
+    def prune(
+        guild_id: int,
+        channel_id: int,
+        before_message_id: Optional[int] = None,
+        limit: int = 1000,
+    ) -> List[RepostReport]:
+        """Remove batch of channel reports, see ImageHash.prune().
+
+        :param before_message_id: Only remove reports of reposts older than
+            this snowflake. All reports of the channel are removed if None.
+        :return: The removed reports.
+        """
+        query = session.query(RepostReport).filter_by(
+            guild_id=guild_id, channel_id=channel_id
+        )
+        if before_message_id is not None:
+            query = query.filter(RepostReport.message_id < before_message_id)
+        reports: List[RepostReport] = query.limit(limit).all()
+        for report in reports:
+            session.delete(report)
+        session.commit()
+        return reports
+
     def __repr__(self) -> str:
         return (
             f'<{self.__class__.__name__} idx="{self.idx}" '
-            f'guild_id="{self.guild_id}" channel_id="{self.channel_id}">'
+            f'guild_id="{self.guild_id}" channel_id="{self.channel_id}" '
+            f'message_id="{self.message_id}" report_id="{self.report_id}">'
         )
 
-    def dump(self) -> Dict[str, Union[int, str]]:
+    def dump(self) -> Dict[str, int]:
         return {
             "guild_id": self.guild_id,
             "channel_id": self.channel_id,
+            "message_id": self.message_id,
+            "report_id": self.report_id,
         }
@@ -0,0 +1,213 @@
+"""
+Image decoding and hashing, run outside of the event loop.
+
+The functions in this file are executed in worker processes, so they have to
+stay importable without the bot and its dependencies.
+"""
+
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Optional, Tuple
+
+import dhash
+from PIL import Image
+
+from .scheduler import BACKFILL, LIVE, PrioritySlots
+from .stats import Stats
+
+POOL_KINDS = ("process", "thread")
+
+REDUCED_SIZE = 256
+"""Shorter side of the image passed to dhash after reduced decode.
+
+dhash only needs 9x9 thumbnail. Downscaling to this size first keeps the
+hashes within few bits of the ones computed from full image, see
+_test/bench_dhash_decode.py.
+"""
+
+HASH_SIZE = 8
+"""Default size of the dhash grid, the hash has ``2 * size ** 2`` bits."""
+HASH_SIZES = (4, 6, 8, 10, 12, 14, 16)
+"""Allowed sizes of the grid, only even ones give hashes of whole bytes."""
+HASH_BITS = 2 * HASH_SIZE**2
+"""Hash size the distance thresholds of the module are set for."""
+
+
+def get_bits(hash_size: int) -> int:
+    """Get number of bits of hash with given grid size."""
+    return 2 * hash_size**2
+
+
+def scale_limit(limit: int, bits: int) -> int:
+    """Scale distance threshold set for HASH_BITS to hash of other size."""
+    return round(limit * bits / HASH_BITS)
+
+
+DECODE_ERRORS = (OSError, ValueError, SyntaxError, Image.DecompressionBombError)
+"""Errors raised by Pillow for broken or malicious images."""
+
+
+def reduce_image(image: Image.Image) -> Image.Image:
+    """Convert image to small grayscale one, decoding as little as possible."""
+    # JPEG can be decoded directly in 1/2, 1/4 or 1/8 of its size.
+    # This is no-op for other formats.
+    image.draft("L", (REDUCED_SIZE, REDUCED_SIZE))
+    image = image.convert("L")
+
+    factor: int = min(image.size) // REDUCED_SIZE
+    if factor > 1:
+        image = image.reduce(factor)
+    return image
+
+
+def hash_image(
+    data: bytes, reduced: bool = True, size: int = HASH_SIZE
+) -> Optional[int]:
+    """Decode image and compute its hash.
+
+    :param reduced: Hash downscaled image instead of the full resolution one.
+    :param size: Size of the dhash grid. The hash has ``2 * size ** 2`` bits.
+    :return: The hash or None, if the data could not be decoded.
+    """
+    return hash_image_timed(data, reduced, size)[0]
+
+
+def hash_image_timed(
+    data: bytes, reduced: bool = True, size: int = HASH_SIZE
+) -> Tuple[Optional[int], float, float]:
+    """Decode image and compute its hash, see hash_image().
+
+    Workers can't update the statistics of the bot process, so the durations
+    are returned together with the hash.
+
+    :return: The hash or None, seconds spent decoding and seconds spent
+        hashing the image.
+    """
+    start = time.perf_counter()
+    try:
+        image = Image.open(BytesIO(data))
+        if reduced:
+            image = reduce_image(image)
+        else:
+            image.load()
+        decoded = time.perf_counter()
+        h = dhash.dhash_int(image, size=size)
+    except DECODE_ERRORS:
+        return None, time.perf_counter() - start, 0.0
+    return h, decoded - start, time.perf_counter() - decoded
+
+
+class HashPool:
+    """Pool of workers computing image hashes.
+
+    At most ``workers + queue_size`` images are submitted at once. Callers
+    above this limit wait until some of the running jobs finish, so bursts of
+    images are queued as coroutines instead of as raw data in the executor.
+
+    Backfill jobs only get a slot when no live job is waiting, and they can
+    occupy at most ``workers`` slots, see PrioritySlots.
+    """
+
+    def __init__(
+        self,
+        kind: str = "process",
+        workers: int = 2,
+        queue_size: int = 8,
+        stats: Optional[Stats] = None,
+    ):
+        if kind not in POOL_KINDS:
+            raise ValueError(f"Unknown pool kind '{kind}'.")
+        if workers < 1 or queue_size < 0:
+            raise ValueError("Pool needs at least one worker.")
+
+        self.kind: str = kind
+        self.workers: int = workers
+        self.queue_size: int = queue_size
+        self.stats: Stats = stats if stats is not None else Stats()
+
+        self._executor: Executor = self._create_executor()
+        self._slots = PrioritySlots(workers + queue_size, workers)
+        self._closed: bool = False
+
+    def _create_executor(self) -> Executor:
+        if self.kind == "process":
+            return ProcessPoolExecutor(max_workers=self.workers)
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="dhash")
+
+    @property
+    def running(self) -> int:
+        """Number of images being hashed."""
+        return self._slots.running
+
+    @property
+    def waiting(self) -> int:
+        """Number of images waiting for a free slot."""
+        return self._slots.waiting
+
+    @property
+    def backlog(self) -> bool:
+        return self._slots.backlog
+
+    async def wait_for_live(self):
+        """Wait until live messages have no images waiting."""
+        await self._slots.wait_for_live()
+
+    async def hash(
+        self, data: bytes, backfill: bool = False, size: int = HASH_SIZE
+    ) -> Optional[int]:
+        """Compute image hash in the pool.
+
+        :param backfill: Run the job in the low priority lane.
+        :param size: Size of the dhash grid, see hash_image().
+        :return: The hash or None, if the data could not be decoded.
+        """
+        lane: str = BACKFILL if backfill else LIVE
+        with self.stats.timer("queue", lane=lane):
+            await self._slots.acquire(lane)
+        executor = self._executor
+        try:
+            loop = asyncio.get_running_loop()
+            h, decode, hashing = await loop.run_in_executor(
+                executor, hash_image_timed, data, True, size
+            )
+        except BrokenProcessPool:
+            # A worker died, e.g. while decoding malicious image. Other jobs
+            # sent to the same executor fail as well, only the first one
+            # replaces it.
+            if self._executor is executor:
+                self._executor = self._create_executor()
+                executor.shutdown(wait=False, cancel_futures=True)
+            self.stats.count("images_failed")
+            return None
+        except RuntimeError:
+            # The pool was shut down with cancel_futures while the job waited
+            self.stats.count("images_failed")
+            return None
+        finally:
+            self._slots.release(lane)
+            if self._closed and not self._slots.waiting:
+                self._executor.shutdown(wait=False)
+
+        self.stats.observe("decode", decode)
+        if h is None:
+            self.stats.count("images_failed")
+            return None
+        self.stats.observe("hash", hashing)
+        self.stats.count("images_hashed", size=size)
+        return h
+
+    def shutdown(self, cancel_futures: bool = False):
+        """Stop the workers once they finish all submitted images.
+
+        Images waiting for a slot are still hashed, the executor is stopped
+        after the last of them gets one.
+
+        :param cancel_futures: Drop the images which have not started yet,
+            the waiting ones fail right away.
+        """
+        self._closed = True
+        if cancel_futures or not self._slots.waiting:
+            self._executor.shutdown(wait=False, cancel_futures=cancel_futures)
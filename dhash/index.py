@@ -0,0 +1,550 @@
+"""
+In-memory index for near-duplicate image hash lookup.
+
+Hashes are stored as packed arrays of 64bit words, so that distances to many
+rows can be computed in single vectorized XOR and popcount pass.
+
+The hash is also split into ``radius + 1`` chunks. By the pigeonhole principle,
+two hashes which differ in at most ``radius`` bits have at least one chunk
+in common, so only rows sharing a chunk value with the query have to be
+compared instead of the whole guild. The rows are found by binary search in
+arrays sorted by the value of each chunk, so the lookup cost depends on the
+number of similar hashes, not on the number of channels the index covers.
+"""
+
+import os
+from pathlib import Path
+from typing import Collection, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+WORD_BITS = 64
+WORD_MASK = (1 << WORD_BITS) - 1
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """Count set bits in each row of 2D array of uint64 words."""
+    if hasattr(np, "bitwise_count"):
+        counts = np.bitwise_count(words)
+    else:
+        # numpy < 2.0
+        counts = _POPCOUNT_TABLE[np.ascontiguousarray(words).view(np.uint8)]
+    return counts.sum(axis=1, dtype=np.int64)
+
+
+def chunk_layout(bits: int, radius: int) -> List[Tuple[int, int]]:
+    """Split hash into chunks, so that hashes differing in at most radius
+    bits share the value of at least one of them.
+
+    More chunks than radius + 1 keep the pigeonhole guarantee, so the count
+    is raised if the chunks would not fit into 64bit word.
+
+    :return: Bit offset and mask of each chunk.
+    """
+    count: int = max(min(radius + 1, bits), -(-bits // WORD_BITS))
+    chunks: List[Tuple[int, int]] = []
+    offset: int = 0
+    for i in range(count):
+        width = bits // count + (1 if i < bits % count else 0)
+        chunks.append((offset, (1 << width) - 1))
+        offset += width
+    return chunks
+
+
+def chunk_values(
+    hashes: np.ndarray, chunks: List[Tuple[int, int]]
+) -> Iterable[np.ndarray]:
+    """Get values of each chunk for 2D array of hash words.
+
+    :param chunks: The layout from chunk_layout().
+    """
+    words: int = hashes.shape[1]
+    for offset, mask in chunks:
+        word = words - 1 - offset // WORD_BITS
+        shift = offset % WORD_BITS
+        values = hashes[:, word] >> np.uint64(shift)
+        if shift + mask.bit_length() > WORD_BITS:
+            values |= hashes[:, word - 1] << np.uint64(WORD_BITS - shift)
+        yield values & np.uint64(mask)
+
+
+def to_words(value: int, words: int) -> List[int]:
+    """Split integer into 64bit words, most significant first."""
+    return [(value >> (WORD_BITS * i)) & WORD_MASK for i in reversed(range(words))]
+
+
+def from_words(values: Iterable[int]) -> int:
+    result = 0
+    for value in values:
+        result = result << WORD_BITS | int(value)
+    return result
+
+
+def pack(value: int, bits: int = 128) -> bytes:
+    """Convert hash into big-endian bytes, as it is stored in the database."""
+    return value.to_bytes(-(-bits // 8), "big")
+
+
+def unpack(data: bytes) -> int:
+    return int.from_bytes(data, "big")
+
+
+def snapshot_dtype(words: int) -> np.dtype:
+    """Get type of rows in the array created by HashIndex.to_array()."""
+    return np.dtype(
+        [
+            ("idx", "<i8"),
+            ("channel_id", "<i8"),
+            ("message_id", "<i8"),
+            ("hash", "<u8", (words,)),
+        ]
+    )
+
+
+def save_snapshot(path: Path, array: np.ndarray):
+    """Write array created by HashIndex.to_array() into file.
+
+    The file is replaced atomically, so crash during the write keeps the
+    previous snapshot intact.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix(".tmp")
+    with temporary.open("wb") as handle:
+        np.save(handle, array, allow_pickle=False)
+    os.replace(temporary, path)
+
+
+def load_snapshot(path: Path, words: int) -> Optional[np.ndarray]:
+    """Memory-map snapshot written by save_snapshot().
+
+    :return: The array or None, if the file is missing, damaged or has
+        different hash size.
+    """
+    try:
+        array = np.load(path, mmap_mode="r", allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+    if array.dtype != snapshot_dtype(words) or array.ndim != 1:
+        return None
+    return array
+
+
+class IndexEntry(NamedTuple):
+    """Single stored hash."""
+
+    idx: int
+    channel_id: int
+    message_id: int
+    hash: int
+
+
+def snapshot_entry(row: np.void) -> IndexEntry:
+    """Convert row of array created by HashIndex.to_array()."""
+    return IndexEntry(
+        idx=int(row["idx"]),
+        channel_id=int(row["channel_id"]),
+        message_id=int(row["message_id"]),
+        hash=from_words(row["hash"]),
+    )
+
+
+class HashIndex:
+    """Multi-index of image hashes.
+
+    Lookups return the same row the linear scan over the database would: the
+    one with the lowest distance, ties broken by the lowest ``idx``.
+
+    Rows live in packed arrays. For every chunk, and for ``idx`` and message
+    ID, there is a table of the row keys sorted by argsort, together with the
+    row positions in the same order, so rows with given key are found by
+    binary search. Rows added since the tables were last sorted form a tail,
+    which is always compared in full. Removed rows are only marked as dead
+    until enough of them accumulate to compact the arrays.
+    """
+
+    # When the chunk buckets yield more than this fraction of rows, it is
+    # faster to compare the query against all of them.
+    SCAN_RATIO = 0.25
+    # The unsorted tail is merged into the tables once it has more rows than
+    # this, or than the given fraction of all rows.
+    TAIL_SIZE = 1024
+    TAIL_RATIO = 1 / 32
+
+    def __init__(self, bits: int = 128, radius: int = 13):
+        self.bits: int = bits
+        self.radius: int = radius
+        self.words: int = -(-bits // WORD_BITS)
+
+        self._chunks: List[Tuple[int, int]] = chunk_layout(bits, radius)
+        # The narrowest type the chunk values fit in, the tables hold one
+        # value per row and chunk
+        width: int = max(mask.bit_length() for _, mask in self._chunks)
+        self._key_type = next(
+            key_type
+            for key_type in (np.uint16, np.uint32, np.uint64)
+            if width <= np.iinfo(key_type).bits
+        )
+
+        self._size: int = 0
+        self._dead: int = 0
+        self._hashes = np.zeros((0, self.words), dtype=np.uint64)
+        self._rows = np.zeros(0, dtype=np.int64)
+        self._channel_ids = np.zeros(0, dtype=np.int64)
+        self._message_ids = np.zeros(0, dtype=np.int64)
+        self._alive = np.zeros(0, dtype=bool)
+
+        # Sorted tables of the chunks, then of idx and of message ID. They
+        # cover rows before the tail start.
+        self._tail: int = 0
+        tables: int = len(self._chunks) + 2
+        self._keys: List[np.ndarray] = [
+            np.zeros(0, dtype=self._key_type) for _ in self._chunks
+        ] + [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)]
+        self._order: List[np.ndarray] = [
+            np.zeros(0, dtype=np.int32) for _ in range(tables)
+        ]
+
+    def __len__(self) -> int:
+        return self._size - self._dead
+
+    @property
+    def _row_table(self) -> int:
+        return len(self._chunks)
+
+    @property
+    def _message_table(self) -> int:
+        return len(self._chunks) + 1
+
+    def _keys_of(self, value: int) -> Iterable[Tuple[int, int]]:
+        for i, (shift, mask) in enumerate(self._chunks):
+            yield i, (value >> shift) & mask
+
+    def _reserve(self, size: int):
+        capacity = len(self._rows)
+        if size <= capacity:
+            return
+        self._resize(max(size, capacity * 2, 64))
+
+    def _resize(self, capacity: int):
+        for name in ("_hashes", "_rows", "_channel_ids", "_message_ids", "_alive"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[: self._size] = old[: self._size]
+            setattr(self, name, new)
+
+    def _entry(self, position: int) -> IndexEntry:
+        return IndexEntry(
+            idx=int(self._rows[position]),
+            channel_id=int(self._channel_ids[position]),
+            message_id=int(self._message_ids[position]),
+            hash=from_words(self._hashes[position]),
+        )
+
+    def _table_values(self, start: int, end: int) -> Iterable[np.ndarray]:
+        """Get keys of rows at given positions for each table."""
+        yield from chunk_values(self._hashes[start:end], self._chunks)
+        yield self._rows[start:end]
+        yield self._message_ids[start:end]
+
+    def _merge(self):
+        """Add the tail into the sorted tables.
+
+        Both parts are already sorted, which the stable sort merges in
+        linear time.
+        """
+        start, end = self._tail, self._size
+        if start == end:
+            return
+        positions = np.arange(start, end, dtype=np.int32)
+        for i, values in enumerate(self._table_values(start, end)):
+            keys = np.concatenate((self._keys[i], values.astype(self._keys[i].dtype)))
+            order = np.concatenate((self._order[i], positions))
+            permutation = np.argsort(keys, kind="stable")
+            self._keys[i] = keys[permutation]
+            self._order[i] = order[permutation]
+        self._tail = end
+
+    def _maybe_merge(self):
+        if self._size - self._tail > max(self.TAIL_SIZE, self._size * self.TAIL_RATIO):
+            self._merge()
+
+    def _lookup(self, table: int, key: int) -> np.ndarray:
+        """Get positions of rows with given key, including the dead ones.
+
+        Only the sorted part is searched, the tail has to be checked by the
+        caller.
+        """
+        keys = self._keys[table]
+        key = keys.dtype.type(key)
+        start = np.searchsorted(keys, key, side="left")
+        end = np.searchsorted(keys, key, side="right")
+        return self._order[table][start:end]
+
+    def _find(self, table: int, values: np.ndarray, column: np.ndarray) -> np.ndarray:
+        """Get positions of alive rows whose key is one of the values.
+
+        :param column: The keys of all rows, for the tail.
+        """
+        keys = self._keys[table]
+        values = values.astype(keys.dtype)
+        starts = np.searchsorted(keys, values, side="left")
+        ends = np.searchsorted(keys, values, side="right")
+        hits = starts < ends
+        parts = [self._order[table][s:e] for s, e in zip(starts[hits], ends[hits])]
+        tail = self._tail + np.flatnonzero(
+            np.isin(column[self._tail : self._size], values)
+        )
+        positions = np.concatenate(parts + [tail]).astype(np.int64)
+        return positions[self._alive[positions]]
+
+    def add(self, entry: IndexEntry):
+        """Add hash to the index. Adding the same row twice is no-op."""
+        if len(self._find(self._row_table, np.array([entry.idx]), self._rows)):
+            return
+
+        self._reserve(self._size + 1)
+        position = self._size
+        self._hashes[position] = to_words(entry.hash, self.words)
+        self._rows[position] = entry.idx
+        self._channel_ids[position] = entry.channel_id
+        self._message_ids[position] = entry.message_id
+        self._alive[position] = True
+        self._size += 1
+        self._maybe_merge()
+
+    def extend(self, entries: Iterable[IndexEntry]):
+        for entry in entries:
+            self.add(entry)
+
+    def channel_sizes(self) -> Dict[int, int]:
+        """Get number of hashes of each channel."""
+        alive = self._alive[: self._size]
+        channel_ids, counts = np.unique(
+            self._channel_ids[: self._size][alive], return_counts=True
+        )
+        return dict(zip(channel_ids.tolist(), counts.tolist()))
+
+    def to_array(self) -> np.ndarray:
+        """Get all rows as structured array ordered by ``idx``."""
+        positions = np.flatnonzero(self._alive[: self._size])
+        positions = positions[np.argsort(self._rows[positions], kind="stable")]
+        array = np.empty(len(positions), dtype=snapshot_dtype(self.words))
+        array["idx"] = self._rows[positions]
+        array["channel_id"] = self._channel_ids[positions]
+        array["message_id"] = self._message_ids[positions]
+        array["hash"] = self._hashes[positions]
+        return array
+
+    def extend_array(self, array: np.ndarray):
+        """Add rows from structured array, see to_array().
+
+        Rows are added in bulk, which is much faster than extend() when the
+        whole index is loaded. Already known rows are skipped.
+        """
+        if len(self):
+            known = self._rows[self._find(self._row_table, array["idx"], self._rows)]
+            array = array[~np.isin(array["idx"], known)]
+        count: int = len(array)
+        if not count:
+            return
+
+        start: int = self._size
+        self._reserve(start + count)
+        self._rows[start : start + count] = array["idx"]
+        self._channel_ids[start : start + count] = array["channel_id"]
+        self._message_ids[start : start + count] = array["message_id"]
+        self._hashes[start : start + count] = array["hash"]
+        self._alive[start : start + count] = True
+        self._size += count
+        self._maybe_merge()
+
+    def remove_message(self, message_id: int) -> int:
+        """Remove all hashes of given message.
+
+        :return: Number of removed hashes.
+        """
+        return self.remove_messages([message_id])
+
+    def remove_messages(self, message_ids: Iterable[int]) -> int:
+        """Remove all hashes of given messages.
+
+        :return: Number of removed hashes.
+        """
+        message_ids = np.fromiter(message_ids, dtype=np.int64)
+        return self._remove_positions(
+            self._find(self._message_table, message_ids, self._message_ids)
+        )
+
+    def remove(self, indices: Iterable[int]) -> int:
+        """Remove hashes by their row ``idx``. Unknown rows are skipped.
+
+        :return: Number of removed hashes.
+        """
+        indices = np.fromiter(indices, dtype=np.int64)
+        return self._remove_positions(self._find(self._row_table, indices, self._rows))
+
+    def _remove_positions(self, positions: np.ndarray) -> int:
+        positions = np.unique(positions)
+        self._alive[positions] = False
+        self._dead += len(positions)
+        if self._dead * 4 > self._size:
+            self._compact()
+        return len(positions)
+
+    def _compact(self):
+        """Drop the dead rows, and release memory when most of it is unused.
+
+        The tables keep their order, only the positions are renumbered.
+        """
+        keep = self._alive[: self._size]
+        renumber = (np.cumsum(keep) - 1).astype(np.int32)
+        for i, order in enumerate(self._order):
+            mask = keep[order]
+            self._keys[i] = self._keys[i][mask]
+            self._order[i] = renumber[order[mask]]
+        self._tail = int(keep[: self._tail].sum())
+
+        size = int(keep.sum())
+        for name in ("_hashes", "_rows", "_channel_ids", "_message_ids"):
+            array = getattr(self, name)
+            array[:size] = array[: self._size][keep]
+        self._alive[:size] = True
+        self._alive[size : self._size] = False
+        self._size, self._dead = size, 0
+
+        if len(self._rows) > 64 and self._size * 4 <= len(self._rows):
+            self._resize(max(self._size * 2, 64))
+
+    def candidates(self, value: int) -> np.ndarray:
+        """Get positions of rows sharing at least one chunk with given hash.
+
+        All rows of the tail are included.
+        """
+        parts = [self._lookup(i, key) for i, key in self._keys_of(value)]
+        parts.append(np.arange(self._tail, self._size, dtype=np.int32))
+        positions = np.unique(np.concatenate(parts)).astype(np.int64)
+        return positions[self._alive[positions]]
+
+    def _candidate_count(self, value: int) -> int:
+        """Get upper bound of the number of candidates, without collecting them."""
+        count: int = self._size - self._tail
+        for i, key in self._keys_of(value):
+            keys = self._keys[i]
+            key = keys.dtype.type(key)
+            count += int(
+                np.searchsorted(keys, key, side="right")
+                - np.searchsorted(keys, key, side="left")
+            )
+        return count
+
+    def _positions(self, value: int, radius: int) -> np.ndarray:
+        """Get positions worth comparing to the hash within the radius."""
+        if radius <= self.radius:
+            if self._candidate_count(value) <= len(self) * self.SCAN_RATIO:
+                return self.candidates(value)
+        return np.flatnonzero(self._alive[: self._size])
+
+    def distances(
+        self, value: int, positions: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Compute distances of given hash to the rows at given positions.
+
+        :param positions: Array positions. All rows are compared if omitted.
+        """
+        query = np.array(to_words(value, self.words), dtype=np.uint64)
+        hashes = self._hashes[: self._size]
+        if positions is not None:
+            hashes = hashes[positions]
+        return popcount(np.bitwise_xor(hashes, query))
+
+    def scan(
+        self,
+        value: int,
+        exclude_message_id: Optional[int] = None,
+        positions: Optional[np.ndarray] = None,
+        channel_ids: Optional[Collection[int]] = None,
+    ) -> Optional[Tuple[IndexEntry, int]]:
+        """Find the closest hash within the index radius by comparing rows.
+
+        This is exact and does not use the chunk tables.
+
+        :param positions: Array positions to compare. All rows if omitted.
+        :param channel_ids: Only compare hashes from these channels.
+        """
+        if positions is None:
+            positions = np.flatnonzero(self._alive[: self._size])
+        if not len(positions):
+            return None
+
+        distances = self.distances(value, positions)
+        mask = distances <= self.radius
+        if exclude_message_id is not None:
+            mask &= self._message_ids[positions] != exclude_message_id
+        if channel_ids is not None:
+            mask &= np.isin(
+                self._channel_ids[positions], np.fromiter(channel_ids, dtype=np.int64)
+            )
+        if not mask.any():
+            return None
+
+        positions, distances = positions[mask], distances[mask]
+        best = distances.min()
+        positions = positions[distances == best]
+        position = positions[np.argmin(self._rows[positions])]
+        return self._entry(int(position)), int(best)
+
+    def nearest(
+        self,
+        value: int,
+        exclude_message_id: Optional[int] = None,
+        channel_ids: Optional[Collection[int]] = None,
+    ) -> Optional[Tuple[IndexEntry, int]]:
+        """Find the closest hash within the index radius.
+
+        :param value: Searched hash.
+        :param exclude_message_id: Message whose hashes should be ignored.
+        :param channel_ids: Only return hashes from these channels. All
+            channels if omitted.
+        :return: Tuple of entry and its distance, or None.
+        """
+        positions = self._positions(value, self.radius)
+        return self.scan(value, exclude_message_id, positions, channel_ids)
+
+    def search(
+        self,
+        value: int,
+        count: int,
+        radius: Optional[int] = None,
+        exclude_message_id: Optional[int] = None,
+        channel_ids: Optional[Collection[int]] = None,
+    ) -> List[Tuple[IndexEntry, int]]:
+        """Find the closest hashes.
+
+        :param count: Maximal number of results.
+        :param radius: Maximal distance of the results. The index radius is
+            used if omitted. Larger radius than the one of the index can't use
+            the chunk tables, so all rows are compared.
+        :return: Tuples of entry and its distance, the closest first, ties
+            ordered by ``idx``.
+        """
+        if radius is None:
+            radius = self.radius
+
+        positions = self._positions(value, radius)
+        if not len(positions):
+            return []
+
+        distances = self.distances(value, positions)
+        mask = distances <= radius
+        if exclude_message_id is not None:
+            mask &= self._message_ids[positions] != exclude_message_id
+        if channel_ids is not None:
+            mask &= np.isin(
+                self._channel_ids[positions], np.fromiter(channel_ids, dtype=np.int64)
+            )
+        positions, distances = positions[mask], distances[mask]
+
+        order = np.lexsort((self._rows[positions], distances))[:count]
+        return [(self._entry(int(positions[i])), int(distances[i])) for i in order]
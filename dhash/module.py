@@ -1,18 +1,40 @@
 import asyncio
+import datetime
+import hashlib
 import re
 import time
 from io import BytesIO
+from typing import Dict, List, Literal, Optional, Sequence, Set, Tuple
 
 import aiohttp
-import dhash
-from PIL import Image
+import numpy as np
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 from pie import check, i18n, logger, utils
 
-from .database import HashChannel, HashConfig, ImageHash
+from .cache import TTLCache
+from .cluster import find_clusters
+from .database import (
+    HashChannel,
+    HashCheckpoint,
+    HashConfig,
+    ImageDigest,
+    ImageHash,
+    RepostReport,
+)
+from .hashing import (
+    HASH_BITS,
+    HASH_SIZE,
+    HASH_SIZES,
+    REDUCED_SIZE,
+    HashPool,
+    get_bits,
+    scale_limit,
+)
+from .index import HashIndex, IndexEntry, save_snapshot
+from .stats import Stats
 
 _ = i18n.Translator("modules/fun").translate
 guild_log = logger.Guild.logger()
@@ -22,6 +44,14 @@ LIMIT_FULL = 3
 LIMIT_HARD = 7
 LIMIT_SOFT = 14
 
+
+SEARCH_COUNT = 5
+SEARCH_MAX_COUNT = 20
+
+CLUSTER_COUNT = 10
+CLUSTER_STATUS_INTERVAL = 3
+"""Seconds between updates of clustering progress."""
+
 MAX_ATTACHMENT_SIZE = 8000
 ALLOWED_FORMATS = ("jpg", "jpeg", "png", "webp", "gif")
 
@@ -29,6 +59,40 @@ HTTP_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/97.0.4692.71 Safari/537.36"
 }
 
+MESSAGE_IMAGES = 4
+
+PRUNE_INTERVAL = 1
+"""Hours between deleting hashes older than retention window."""
+PRUNE_BATCH = 1000
+SNAPSHOT_INTERVAL = 6
+"""Hours between writing index snapshots, see ImageHash.get_index()."""
+
+HISTORY_WORKERS = 8
+HISTORY_BATCH = 100
+
+POOL_KIND = "process"
+POOL_WORKERS = 2
+POOL_QUEUE = 8
+
+HTTP_CONNECTIONS = 16
+HTTP_CONNECTIONS_PER_HOST = 4
+HTTP_DNS_CACHE = 300
+DOWNLOAD_CHUNK = 64 * 1024
+DOWNLOAD_ERRORS = (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError)
+"""Errors of Discord CDN downloads, which raises the aiohttp ones directly."""
+
+DIGEST_SIZE = 16
+
+EMBED_CACHE_SIZE = 10_000
+EMBED_CACHE_TTL = 7 * 24 * 60 * 60
+
+ORIGINAL_CACHE_SIZE = 4096
+ORIGINAL_CACHE_TTL = 60 * 60
+
+URL_CACHE_SIZE = 4096
+URL_CACHE_TTL = 60 * 60
+URL_ERROR_TTL = 5 * 60
+
 URL_REGEX = r"(https?://[^\s]+)"
 DISCORD_REGEX = r"^https://(?:cdn\.discordapp\.com|media\.discordapp\.net)/"
 
@@ -36,7 +100,29 @@ DISCORD_REGEX = r"^https://(?:cdn\.discordapp\.com|media\.discordapp\.net)/"
 class Dhash(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.embed_cache = {}
+        # Repost message ID to tuple of (report channel ID, report message ID)
+        # tuples, one for each report of the message
+        self.embed_cache = TTLCache(EMBED_CACHE_SIZE, EMBED_CACHE_TTL)
+        # Report message ID to [repost message ID, number of ❎ reactions]
+        self.report_votes = TTLCache(EMBED_CACHE_SIZE, EMBED_CACHE_TTL)
+        self.session: Optional[aiohttp.ClientSession] = None
+
+        ImageHash.migrate()
+        ImageDigest.migrate()
+        HashChannel.migrate()
+        ImageHash.move_snapshots()
+
+        # (guild ID, channel ID) to HashChannel.dump(), so the listeners
+        # don't have to query the database on every event
+        self.hash_channels: Dict[Tuple[int, int], dict] = {
+            (channel.guild_id, channel.channel_id): channel.dump()
+            for channel in HashChannel.get_all(None)
+        }
+        # Original message ID to (author name, jump URL), or to None if the
+        # message does not exist anymore
+        self.original_cache = TTLCache(ORIGINAL_CACHE_SIZE, ORIGINAL_CACHE_TTL)
+        # (hash size, URL) to its hash, or to None if it does not point to an image
+        self.url_cache = TTLCache(URL_CACHE_SIZE, URL_CACHE_TTL)
 
         self.allowed_urls = HashConfig.get("allowed_urls", None)
 
@@ -45,6 +131,71 @@ class Dhash(commands.Cog):
         except (re.error, TypeError):
             self.allowed_urls = None
 
+        self.thumbnails: bool = HashConfig.get("thumbnails", "0") == "1"
+
+        # Timings of the processing stages, see dhash stats
+        self.stats = Stats()
+
+        try:
+            self.pool = HashPool(
+                kind=HashConfig.get("pool_kind", POOL_KIND),
+                workers=int(HashConfig.get("pool_workers", POOL_WORKERS)),
+                queue_size=int(HashConfig.get("pool_queue", POOL_QUEUE)),
+                stats=self.stats,
+            )
+        except ValueError:
+            self.pool = HashPool(POOL_KIND, POOL_WORKERS, POOL_QUEUE, self.stats)
+
+        # (guild ID, hash bits) to task loading its index, see _get_index()
+        self.index_loads: Dict[Tuple[int, int], asyncio.Task] = {}
+        self.index_warmup: Optional[asyncio.Task] = None
+
+        self.prune_hashes.start()
+        self.save_snapshots.start()
+
+    async def cog_load(self):
+        self.index_warmup = asyncio.create_task(self._warm_up_indexes())
+
+    async def cog_unload(self):
+        self.prune_hashes.cancel()
+        self.save_snapshots.cancel()
+        if self.index_warmup is not None:
+            self.index_warmup.cancel()
+        for path, array in ImageHash.get_snapshots().items():
+            save_snapshot(path, array)
+        self.pool.shutdown(cancel_futures=True)
+        if self.session is not None:
+            await self.session.close()
+
+    @tasks.loop(hours=PRUNE_INTERVAL)
+    async def prune_hashes(self):
+        """Delete hashes, digests and reports older than retention window."""
+        now = discord.utils.utcnow()
+        for (guild_id, channel_id), hash_channel in list(self.hash_channels.items()):
+            if not hash_channel["retention_days"]:
+                continue
+            before = now - datetime.timedelta(days=hash_channel["retention_days"])
+            await self._prune_channel(
+                guild_id, channel_id, discord.utils.time_snowflake(before)
+            )
+
+    @prune_hashes.before_loop
+    async def before_prune_hashes(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(hours=SNAPSHOT_INTERVAL)
+    async def save_snapshots(self):
+        """Write loaded indices to disk, so they load fast after restart."""
+        if self.save_snapshots.current_loop == 0:
+            # There is nothing new right after start
+            return
+        for path, array in ImageHash.get_snapshots().items():
+            await asyncio.to_thread(save_snapshot, path, array)
+
+    @save_snapshots.before_loop
+    async def before_save_snapshots(self):
+        await self.bot.wait_until_ready()
+
     def _in_repost_channel(self, message: discord.Message) -> bool:
         if message.guild is None:
             return False
@@ -55,8 +206,7 @@ class Dhash(commands.Cog):
         ) and not re.search(URL_REGEX, message.content):
             return False
 
-        channel = HashChannel.get(message.guild.id, message.channel.id)
-        if not channel:
+        if (message.guild.id, message.channel.id) not in self.hash_channels:
             return False
 
         return True
@@ -131,6 +281,102 @@ class Dhash(commands.Cog):
             )
         )
 
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @dhash.group(name="pool")
+    async def dhash_pool(self, ctx):
+        await utils.discord.send_help(ctx)
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @dhash_pool.command(name="get")
+    async def dhash_pool_get(self, ctx):
+        await ctx.reply(
+            _(
+                ctx,
+                "Images are hashed by **{workers}** {kind} workers "
+                "with queue of **{queue_size}** images.",
+            ).format(
+                workers=self.pool.workers,
+                kind=self.pool.kind,
+                queue_size=self.pool.queue_size,
+            )
+        )
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @dhash_pool.command(name="set")
+    async def dhash_pool_set(
+        self,
+        ctx,
+        kind: Literal["process", "thread"],
+        workers: int,
+        queue_size: int,
+    ):
+        """Configure workers computing image hashes.
+
+        Args:
+            kind: Run workers as processes or as threads.
+            workers: Number of workers.
+            queue_size: How many images can wait for a free worker.
+        """
+        try:
+            pool = HashPool(kind, workers, queue_size, self.stats)
+        except ValueError:
+            await ctx.reply(
+                _(
+                    ctx,
+                    "Pool needs at least one worker and queue size can't be negative.",
+                )
+            )
+            return
+
+        HashConfig.set("pool_kind", kind)
+        HashConfig.set("pool_workers", str(workers))
+        HashConfig.set("pool_queue", str(queue_size))
+
+        old_pool, self.pool = self.pool, pool
+        old_pool.shutdown()
+
+        await bot_log.info(
+            ctx.author,
+            ctx.channel,
+            f"DHash pool was set to {workers} {kind} workers "
+            f"with queue of {queue_size} images.",
+        )
+        await ctx.reply(_(ctx, "Hashing pool was updated."))
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @dhash.group(name="thumbnail")
+    async def dhash_thumbnail(self, ctx):
+        await utils.discord.send_help(ctx)
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @dhash_thumbnail.command(name="get")
+    async def dhash_thumbnail_get(self, ctx):
+        if self.thumbnails:
+            await ctx.reply(_(ctx, "Attachments are downloaded as thumbnails."))
+        else:
+            await ctx.reply(_(ctx, "Attachments are downloaded in full size."))
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @dhash_thumbnail.command(name="set")
+    async def dhash_thumbnail_set(self, ctx, enabled: bool):
+        """Download resized attachments from Discord media proxy.
+
+        Args:
+            enabled: Whether to use thumbnails instead of the original files.
+        """
+        HashConfig.set("thumbnails", "1" if enabled else "0")
+        self.thumbnails = enabled
+
+        await bot_log.info(
+            ctx.author,
+            ctx.channel,
+            f"DHash thumbnail downloads were {'enabled' if enabled else 'disabled'}.",
+        )
+        if enabled:
+            await ctx.reply(_(ctx, "Attachments are downloaded as thumbnails."))
+        else:
+            await ctx.reply(_(ctx, "Attachments are downloaded in full size."))
+
     @commands.guild_only()
     @check.acl2(check.ACLevel.MOD)
     @dhash.command(name="add")
@@ -148,6 +394,7 @@ class Dhash(commands.Cog):
             return
 
         hash_channel = HashChannel.add(ctx.guild.id, channel.id, reaction_limit)
+        self.hash_channels[(ctx.guild.id, channel.id)] = hash_channel.dump()
         await ctx.send(
             _(
                 ctx,
@@ -184,6 +431,7 @@ class Dhash(commands.Cog):
             return
 
         hash_channel.set_limit(reaction_limit)
+        self.hash_channels[(ctx.guild.id, channel.id)] = hash_channel.dump()
         await ctx.send(
             _(
                 ctx,
@@ -196,6 +444,129 @@ class Dhash(commands.Cog):
             f"Changed reaction limit for channel #{channel.name} to {reaction_limit}.",
         )
 
+    @check.acl2(check.ACLevel.MOD)
+    @dhash.command(name="scope")
+    async def dhash_scope(
+        self, ctx, channel: discord.TextChannel, scope: Literal["channel", "guild"]
+    ):
+        """Set where reposts of images from the channel are searched for.
+
+        Args:
+            channel: The hash channel.
+            scope: 'channel' to search only the channel itself, 'guild' to
+                search all hash channels of the server.
+        """
+        hash_channel = HashChannel.get(ctx.guild.id, channel.id)
+        if not hash_channel:
+            await ctx.reply(
+                _(ctx, "{channel} is not hash channel.").format(channel=channel.mention)
+            )
+            return
+
+        hash_channel.set_scope(scope)
+        self.hash_channels[(ctx.guild.id, channel.id)] = hash_channel.dump()
+        if scope == "guild":
+            message = _(ctx, "Reposts in {channel} are searched in all hash channels.")
+        else:
+            message = _(ctx, "Reposts in {channel} are searched only in the channel.")
+        await ctx.reply(message.format(channel=channel.mention))
+        await guild_log.info(
+            ctx.author,
+            ctx.channel,
+            f"Repost scope of channel #{channel.name} set to {scope}.",
+        )
+
+    @check.acl2(check.ACLevel.MOD)
+    @dhash.command(name="retention")
+    async def dhash_retention(self, ctx, channel: discord.TextChannel, days: int):
+        """Set how long image hashes are kept.
+
+        Args:
+            channel: The hash channel.
+            days: Age of the oldest message whose hashes are kept. Zero to
+                keep them forever.
+        """
+        hash_channel = HashChannel.get(ctx.guild.id, channel.id)
+        if not hash_channel:
+            await ctx.reply(
+                _(ctx, "{channel} is not hash channel.").format(channel=channel.mention)
+            )
+            return
+
+        hash_channel.set_retention(days if days > 0 else None)
+        self.hash_channels[(ctx.guild.id, channel.id)] = hash_channel.dump()
+        if days > 0:
+            message = _(ctx, "Image hashes in {channel} are kept for **{days}** days.")
+        else:
+            message = _(ctx, "Image hashes in {channel} are kept forever.")
+        await ctx.reply(message.format(channel=channel.mention, days=days))
+        await guild_log.info(
+            ctx.author,
+            ctx.channel,
+            f"Hash retention of channel #{channel.name} set to {days} days.",
+        )
+
+    @check.acl2(check.ACLevel.MOD)
+    @dhash.command(name="size")
+    async def dhash_size(self, ctx, channel: discord.TextChannel, hash_size: int):
+        """Set size of image hashes.
+
+        Smaller hashes are faster to look up, but match more unrelated images.
+        Hashes of different size can't be compared, so the hashes of the
+        channel are deleted and its history has to be scanned again.
+
+        Args:
+            channel: The hash channel.
+            hash_size: Size of the hash grid, the hash has 2 * size² bits.
+        """
+        hash_channel = HashChannel.get(ctx.guild.id, channel.id)
+        if not hash_channel:
+            await ctx.reply(
+                _(ctx, "{channel} is not hash channel.").format(channel=channel.mention)
+            )
+            return
+
+        if hash_size not in HASH_SIZES:
+            await ctx.reply(
+                _(ctx, "Hash size must be one of {sizes}.").format(
+                    sizes=", ".join(str(size) for size in HASH_SIZES)
+                )
+            )
+            return
+
+        if hash_size == hash_channel.hash_size:
+            await ctx.reply(
+                _(ctx, "{channel} already uses hash size **{size}**.").format(
+                    channel=channel.mention, size=hash_size
+                )
+            )
+            return
+
+        hash_channel.set_hash_size(hash_size)
+        self.hash_channels[(ctx.guild.id, channel.id)] = hash_channel.dump()
+        HashCheckpoint.remove(ctx.guild.id, channel.id)
+        deleted = await self._prune_channel(ctx.guild.id, channel.id)
+        self._drop_unused_indexes(ctx.guild.id)
+        await ctx.reply(
+            _(
+                ctx,
+                "Hash size of {channel} set to **{size}** ({bits} bits). "
+                "**{count}** old image hashes were deleted, "
+                "scan the channel history again.",
+            ).format(
+                channel=channel.mention,
+                size=hash_size,
+                bits=get_bits(hash_size),
+                count=deleted,
+            )
+        )
+        await guild_log.info(
+            ctx.author,
+            ctx.channel,
+            f"Hash size of channel #{channel.name} set to {hash_size}, "
+            f"{deleted} image hashes were deleted.",
+        )
+
     @check.acl2(check.ACLevel.SUBMOD)
     @dhash.command(name="list")
     async def dhash_list(self, ctx):
@@ -210,7 +581,11 @@ class Dhash(commands.Cog):
         result = []
         for hash_channel, channel in zip(hash_channels, channels):
             name = getattr(channel, "name", "???")
-            line = f"#{name:<{column_name_width}} {hash_channel.channel_id} {hash_channel.reaction_limit}"
+            line = (
+                f"#{name:<{column_name_width}} {hash_channel.channel_id} "
+                f"{hash_channel.reaction_limit} {hash_channel.scope} "
+                f"{hash_channel.retention_days or '∞'} {hash_channel.hash_size}"
+            )
             result.append(line)
 
         await ctx.reply("```" + "\n".join(result) + "```")
@@ -219,11 +594,16 @@ class Dhash(commands.Cog):
     @dhash.command(name="remove", aliases=["rem"])
     async def dhash_remove(self, ctx, channel: discord.TextChannel):
         if HashChannel.remove(ctx.guild.id, channel.id):
+            self.hash_channels.pop((ctx.guild.id, channel.id), None)
+            HashCheckpoint.remove(ctx.guild.id, channel.id)
+            deleted = await self._prune_channel(ctx.guild.id, channel.id)
+            self._drop_unused_indexes(ctx.guild.id)
             message = _(ctx, "Hash channel {channel} removed.")
             await guild_log.info(
                 ctx.author,
                 ctx.channel,
-                f"Channel #{channel.name} is no longer a hash channel.",
+                f"Channel #{channel.name} is no longer a hash channel, "
+                f"{deleted} image hashes were deleted.",
             )
         else:
             message = _(ctx, "{channel} is not hash channel.")
@@ -233,56 +613,140 @@ class Dhash(commands.Cog):
     @commands.max_concurrency(1, per=commands.BucketType.default, wait=False)
     @commands.bot_has_permissions(read_message_history=True)
     @dhash.command(name="history")
-    async def dhash_history(self, ctx, limit: int):
+    async def dhash_history(
+        self,
+        ctx,
+        limit: int,
+        mode: Literal["resume", "incremental", "restart"] = "resume",
+    ):
         """Scan current channel for images and save them as hashes.
         limit: How many messages should be scanned. Negative to scan all.
+        mode: 'resume' continues from the last saved checkpoint, 'incremental'
+            only scans messages newer than the last completed scan, 'restart'
+            starts from the newest message.
         """
         if limit < 0:
             limit = None
 
         gtx = i18n.TranslationContext(ctx.guild.id, None)
-
-        async with ctx.typing():
-            messages = [message async for message in ctx.channel.history(limit=limit)]
-
-        status = await ctx.send(
-            _(gtx, "**LOADING**")
-            + "\n"
-            + _(gtx, "Downloaded **{count}** messages.").format(count=len(messages))
-        )
-
-        await asyncio.sleep(1)
-
-        ctr_nofile: int = 0
+        checkpoint = HashCheckpoint.get(ctx.guild.id, ctx.channel.id)
+        incremental: bool = mode == "incremental"
+
+        if incremental:
+            if checkpoint.completed_id is None:
+                await ctx.reply(_(ctx, "This channel has no completed scan yet."))
+                return
+            history = ctx.channel.history(
+                limit=limit,
+                after=discord.Object(checkpoint.completed_id),
+                oldest_first=True,
+            )
+            header = _(gtx, "Scanning messages newer than **{message_id}**.").format(
+                message_id=checkpoint.completed_id
+            )
+        elif mode == "resume" and checkpoint.last_message_id is not None:
+            history = ctx.channel.history(
+                limit=limit, before=discord.Object(checkpoint.last_message_id)
+            )
+            header = _(gtx, "Resuming scan from message **{message_id}**.").format(
+                message_id=checkpoint.last_message_id
+            )
+        else:
+            checkpoint.scan_start_id = None
+            checkpoint.last_message_id = None
+            checkpoint.save()
+            history = ctx.channel.history(limit=limit)
+            header = _(gtx, "Scanning from the newest message.")
+
+        status = await ctx.send(_(gtx, "**LOADING**") + "\n" + header)
+
+        # Messages are processed out of order, so the checkpoint is only moved
+        # to the point before which all the messages have been processed.
+        queue: asyncio.Queue = asyncio.Queue(maxsize=HISTORY_WORKERS * 4)
+        in_flight: Dict[int, int] = {}
+        finished: Set[int] = set()
+        watermark: int = -1
+        watermark_id: Optional[int] = None
+
+        pending: List[dict] = []
+        ctr_messages: int = 0
         ctr_hashes: int = 0
         now = time.time()
-        for i, message in enumerate(messages, 1):
-            if i % 50 == 0:
-                await status.edit(
-                    content=(
-                        _(gtx, "**SCANNING**")
-                        + "\n"
-                        + _(
-                            gtx,
-                            "Processed **{count}** out of **{total}** messages ({percent} %).",
+
+        def save_progress():
+            if pending:
+                ImageHash.add_bulk(pending[:])
+                pending.clear()
+            if watermark_id is None:
+                return
+            if incremental:
+                checkpoint.completed_id = watermark_id
+            else:
+                checkpoint.last_message_id = watermark_id
+            checkpoint.save()
+
+        async def producer():
+            seq: int = 0
+            async for message in history:
+                if seq == 0 and not incremental and checkpoint.scan_start_id is None:
+                    checkpoint.scan_start_id = message.id
+                    checkpoint.save()
+                in_flight[seq] = message.id
+                await queue.put((seq, message))
+                seq += 1
+            for _ in range(HISTORY_WORKERS):
+                await queue.put(None)
+
+        async def worker():
+            nonlocal ctr_messages, ctr_hashes, watermark, watermark_id
+            while (item := await queue.get()) is not None:
+                seq, message = item
+                rows = await self._get_history_hashes(message)
+                pending.extend(rows)
+                ctr_hashes += len(rows)
+                ctr_messages += 1
+
+                finished.add(seq)
+                while watermark + 1 in finished:
+                    watermark += 1
+                    finished.remove(watermark)
+                    watermark_id = in_flight.pop(watermark)
+
+                if len(pending) >= HISTORY_BATCH:
+                    save_progress()
+
+                if ctr_messages % 50 == 0:
+                    save_progress()
+                    await status.edit(
+                        content=self._get_history_status(
+                            gtx, ctr_messages, limit, ctr_hashes, now
                         )
-                        + "\n"
-                        + _(gtx, "Calculated **{hashes}** hashes.")
-                    ).format(
-                        count=i,
-                        total=len(messages),
-                        percent="{:.1f}".format(i / len(messages) * 100),
-                        hashes=ctr_hashes,
                     )
-                )
-
-            if not len(message.attachments):
-                ctr_nofile += 1
-                continue
 
-            hashes = [x async for x in self._save_hashes(message)]
-            ctr_hashes += len(hashes)
+        jobs = [asyncio.create_task(producer())] + [
+            asyncio.create_task(worker()) for _ in range(HISTORY_WORKERS)
+        ]
+        try:
+            await asyncio.gather(*jobs)
+        finally:
+            # When one of the jobs fails, the others must not keep writing to
+            # the checkpoint after the command has ended
+            for job in jobs:
+                job.cancel()
+            await asyncio.gather(*jobs, return_exceptions=True)
+            save_progress()
+
+        if limit is None or ctr_messages < limit:
+            # The whole history has been processed
+            if not incremental:
+                checkpoint.completed_id = max(
+                    checkpoint.completed_id or 0, checkpoint.scan_start_id or 0
+                )
+                checkpoint.scan_start_id = None
+                checkpoint.last_message_id = None
+            checkpoint.save()
 
+        seconds: float = time.time() - now
         await status.edit(
             content=(
                 _(gtx, "**COMPLETED**")
@@ -293,10 +757,13 @@ class Dhash(commands.Cog):
                     gtx,
                     "Calculated **{hashes}** image hashes in **{seconds}** seconds.",
                 )
+                + "\n"
+                + _(gtx, "Speed **{speed}** images per second.")
             ).format(
-                messages=len(messages),
+                messages=ctr_messages,
                 hashes=ctr_hashes,
-                seconds="{:.1f}".format(time.time() - now),
+                seconds="{:.1f}".format(seconds),
+                speed="{:.1f}".format(ctr_hashes / seconds if seconds else 0),
             )
         )
 
@@ -317,7 +784,7 @@ class Dhash(commands.Cog):
                 _(ctx, "Message **`{message_id}`**").format(message_id=message.id)
             )
             for db_image in db_images:
-                text.append("   > `{hash}`".format(hash=db_image.hash[2:]))
+                text.append("   > `{hash}`".format(hash=db_image.packed_hash.hex()))
             text.append("")
 
         if not len(text):
@@ -325,71 +792,290 @@ class Dhash(commands.Cog):
 
         await ctx.send("\n".join(text))
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
-        if self._in_repost_channel(message):
-            await self._check_message(message)
+    @check.acl2(check.ACLevel.SUBMOD)
+    @dhash.command(name="search")
+    async def dhash_search(
+        self,
+        ctx,
+        message: Optional[discord.Message] = None,
+        count: int = SEARCH_COUNT,
+        radius: int = LIMIT_SOFT - 1,
+    ):
+        """Find where the image has been posted before.
 
-    @commands.Cog.listener()
-    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
-        channel = HashChannel.get(payload.guild_id, payload.channel_id)
-        if channel:
-            ImageHash.delete_by_message(payload.guild_id, payload.message_id)
+        Args:
+            message: Message with the image. Image attached to the command or
+                to the replied message is used if omitted.
+            count: Maximal number of results.
+            radius: Maximal number of different bits. It is scaled for hash
+                channels with other than the default hash size.
+        """
+        if message is None:
+            message = ctx.message
+            reference = message.reference
+            if (
+                not message.attachments
+                and reference is not None
+                and isinstance(reference.resolved, discord.Message)
+            ):
+                message = reference.resolved
+        if not 0 < count <= SEARCH_MAX_COUNT:
+            await ctx.reply(
+                _(ctx, "Result count must be between 1 and {count}.").format(
+                    count=SEARCH_MAX_COUNT
+                )
+            )
+            return
+        if not 0 <= radius <= HASH_BITS:
+            await ctx.reply(
+                _(ctx, "Radius must be between 0 and {bits}.").format(bits=HASH_BITS)
+            )
+            return
 
-    @commands.Cog.listener()
-    async def on_message_delete(self, message: discord.Message):
-        if not self._in_repost_channel(message):
+        # Hashes of each size are searched separately, matches of different
+        # sizes are ranked by the fraction of different bits
+        hash_sizes = sorted(
+            {
+                hash_channel["hash_size"]
+                for (guild_id, _channel_id), hash_channel in self.hash_channels.items()
+                if guild_id == ctx.guild.id
+            }
+        ) or [HASH_SIZE]
+        async with ctx.typing():
+            image_hashes = await self._get_message_hashes(
+                message, save=False, hash_sizes=hash_sizes
+            )
+        if not any(image_hashes.values()):
+            await ctx.reply(_(ctx, "The message has no images."))
             return
 
-        # delete repost embed if we have the report message cached
+        start = time.perf_counter()
+        matches: Dict[IndexEntry, Tuple[int, int]] = {}
+        for hash_size, hashes in image_hashes.items():
+            bits: int = get_bits(hash_size)
+            index = await self._get_index(ctx.guild.id, bits)
+            for image_hash in hashes:
+                for entry, distance in index.search(
+                    image_hash,
+                    count,
+                    scale_limit(radius, bits),
+                    exclude_message_id=message.id,
+                ):
+                    if entry not in matches or distance < matches[entry][0]:
+                        matches[entry] = (distance, bits)
+        results = sorted(
+            matches.items(), key=lambda item: (item[1][0] / item[1][1], item[0].idx)
+        )
+        results = results[:count]
+        milliseconds = (time.perf_counter() - start) * 1000
 
-        if message.author == self.bot.user:
+        if not results:
+            await ctx.reply(_(ctx, "No similar images found."))
             return
 
-        if message.id in self.embed_cache:
-            try:
-                report = self.embed_cache[message.id]
-                await report.delete()
-            except discord.errors.HTTPException as exc:
-                await bot_log.error(
-                    message.author,
-                    message.channel,
-                    f"Could not delete repost embed {message.id} at guild {message.guild.id} using cache.",
-                    exception=exc,
+        lines = [
+            _(ctx, "Found **{count}** similar images in **{time}** ms.").format(
+                count=len(results), time="{:.1f}".format(milliseconds)
+            )
+        ]
+        for entry, (distance, bits) in results:
+            lines.append(
+                "`{distance:>3}` {similarity} <{link}>".format(
+                    distance=distance,
+                    similarity="{:.1f} %".format((1 - distance / bits) * 100),
+                    link="https://discord.com/channels/{}/{}/{}".format(
+                        ctx.guild.id, entry.channel_id, entry.message_id
+                    ),
                 )
-            self.embed_cache.pop(message.id)
+            )
+        await ctx.reply("\n".join(lines))
+
+    @check.acl2(check.ACLevel.SUBMOD)
+    @commands.max_concurrency(1, per=commands.BucketType.default, wait=False)
+    @dhash.command(name="clusters")
+    async def dhash_clusters(
+        self,
+        ctx,
+        channel: Optional[discord.TextChannel] = None,
+        count: int = CLUSTER_COUNT,
+    ):
+        """Show the most reposted images.
+
+        Args:
+            channel: The hash channel. Current channel if omitted.
+            count: Number of shown groups of similar images.
+        """
+        if channel is None:
+            channel = ctx.channel
+        if not 0 < count <= SEARCH_MAX_COUNT:
+            await ctx.reply(
+                _(ctx, "Result count must be between 1 and {count}.").format(
+                    count=SEARCH_MAX_COUNT
+                )
+            )
             return
 
-        # try to find and delete repost report embed, because we don't have it cached
-        async for report in message.channel.history(
-            after=message, limit=3, oldest_first=True
-        ):
-            if not report.author.bot:
-                continue
-            if len(report.embeds) != 1 or type(report.embeds[0].footer.text) is not str:
-                continue
-            if str(message.id) != report.embeds[0].footer.text.split(" | ")[1]:
-                continue
+        bits: int = get_bits(self._get_hash_size(ctx.guild.id, channel.id))
+        rows = (await self._get_index(ctx.guild.id, bits)).to_array()
+        rows = rows[rows["channel_id"] == channel.id]
+        if not len(rows):
+            await ctx.reply(
+                _(ctx, "{channel} has no image hashes.").format(channel=channel.mention)
+            )
+            return
 
-            try:
-                await report.delete()
-            except discord.errors.HTTPException as exc:
-                await bot_log.error(
-                    message.author,
-                    message,
-                    "Could not delete repost embed {msg_id} at guild {guild}".format(
-                        msg_id=message.id, guild=message.guild.id
+        header = _(ctx, "Clustering **{count}** image hashes.").format(count=len(rows))
+        status = await ctx.reply(header)
+
+        # The clustering runs in thread, so the bot stays responsive
+        progress: List[float] = [0.0]
+        job = asyncio.create_task(
+            asyncio.to_thread(
+                find_clusters,
+                np.ascontiguousarray(rows["hash"]),
+                bits,
+                scale_limit(LIMIT_HARD, bits),
+                lambda fraction: progress.__setitem__(0, fraction),
+            )
+        )
+        while not job.done():
+            await asyncio.wait({job}, timeout=CLUSTER_STATUS_INTERVAL)
+            if not job.done():
+                await status.edit(
+                    content=f"{header} ({progress[0] * 100:.0f} %)",
+                )
+        clusters = job.result()[:count]
+
+        if not clusters:
+            await status.edit(content=_(ctx, "No near-duplicate images found."))
+            return
+
+        lines = [
+            _(ctx, "Largest groups of similar images in {channel}:").format(
+                channel=channel.mention
+            )
+        ]
+        for cluster in clusters:
+            members = rows[cluster]
+            first = members[np.argmin(members["idx"])]
+            lines.append(
+                _(
+                    ctx, "**{images}** images in **{messages}** messages, first {link}"
+                ).format(
+                    images=len(members),
+                    messages=len(np.unique(members["message_id"])),
+                    link="<https://discord.com/channels/{}/{}/{}>".format(
+                        ctx.guild.id, first["channel_id"], first["message_id"]
                     ),
-                    exception=exc,
                 )
-            break
+            )
+        await status.edit(content="\n".join(lines))
+
+    @check.acl2(check.ACLevel.SUBMOD)
+    @dhash.group(name="stats")
+    async def dhash_stats(self, ctx):
+        await utils.discord.send_help(ctx)
+
+    @check.acl2(check.ACLevel.SUBMOD)
+    @dhash_stats.command(name="get")
+    async def dhash_stats_get(self, ctx):
+        """Show how long the processing stages of images take."""
+        lines: List[str] = [
+            "{:<28} {:>7} {:>8} {:>8} {:>8} {:>8}".format(
+                "stage", "count", "mean", "p50", "p95", "max"
+            )
+        ]
+        for (stage, labels), histogram in sorted(self.stats.histograms.items()):
+            name = "/".join([stage] + [label for _name, label in labels])
+            lines.append(
+                "{:<28} {:>7} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+                    name,
+                    histogram.count,
+                    histogram.mean * 1000,
+                    histogram.quantile(0.5) * 1000,
+                    histogram.quantile(0.95) * 1000,
+                    histogram.max * 1000,
+                )
+            )
+        lines.append("")
+        for (counter, labels), value in sorted(self.stats.counters.items()):
+            name = "/".join([counter] + [label for _name, label in labels])
+            if counter == "bytes_downloaded":
+                value = "{:.1f} MB".format(value / 1024 / 1024)
+            lines.append(f"{name:<28} {value:>7}")
+        lines.append(f"{'pool/running':<28} {self.pool.running:>7}")
+        lines.append(f"{'pool/waiting':<28} {self.pool.waiting:>7}")
+        lines.append("")
+
+        for (guild_id, channel_id, bits), count in sorted(
+            ImageHash.get_index_sizes().items()
+        ):
+            if guild_id != ctx.guild.id:
+                continue
+            name = getattr(ctx.guild.get_channel(channel_id), "name", "???")
+            lines.append(f"{'#' + name:<28} {count:>7} {bits:>4} bits")
+
+        header = _(ctx, "Statistics since {time}, durations in milliseconds:").format(
+            time=datetime.datetime.fromtimestamp(self.stats.started).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+        )
+        await ctx.reply(header)
+        # Keep each message under the Discord limit
+        chunk: List[str] = []
+        for line in lines + [None]:
+            if line is None or sum(len(c) + 1 for c in chunk) + len(line) > 1900:
+                await ctx.send("```" + "\n".join(chunk) + "```")
+                chunk = []
+            if line is not None:
+                chunk.append(line)
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @dhash_stats.command(name="export")
+    async def dhash_stats_export(self, ctx):
+        """Export the statistics of all servers in Prometheus text format."""
+        with BytesIO(self._export_stats().encode("utf-8")) as data:
+            await ctx.reply(file=discord.File(fp=data, filename="dhash-stats.txt"))
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @dhash_stats.command(name="reset")
+    async def dhash_stats_reset(self, ctx):
+        self.stats.reset()
+        await ctx.reply(_(ctx, "Statistics were reset."))
+        await bot_log.info(ctx.author, ctx.channel, "DHash statistics were reset.")
 
     @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload):
-        """Handle 'This is a repost' report.
-        The footer contains reposter's user ID and repost message id.
+    async def on_message(self, message: discord.Message):
+        if self._in_repost_channel(message):
+            with self.stats.timer("message"):
+                await self._check_message(message)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        if (payload.guild_id, payload.channel_id) in self.hash_channels:
+            ImageHash.delete_by_message(payload.guild_id, payload.message_id)
+            self.original_cache.pop(payload.message_id)
+            await self._delete_reports(payload.guild_id, [payload.message_id])
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(
+        self, payload: discord.RawBulkMessageDeleteEvent
+    ):
+        if (payload.guild_id, payload.channel_id) in self.hash_channels:
+            message_ids = sorted(payload.message_ids)
+            ImageHash.delete_by_messages(payload.guild_id, message_ids)
+            for message_id in message_ids:
+                self.original_cache.pop(message_id)
+            await self._delete_reports(payload.guild_id, message_ids)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        """Handle 'This is not a repost' votes on reports.
+
+        The votes are counted in memory. The report is only fetched once, to
+        learn how many votes it already has.
         """
-        hash_channel = HashChannel.get(payload.guild_id, payload.channel_id)
+        hash_channel = self.hash_channels.get((payload.guild_id, payload.channel_id))
 
         if not hash_channel:
             return
@@ -402,200 +1088,772 @@ class Dhash(commands.Cog):
             return
 
         channel = self.bot.get_guild(payload.guild_id).get_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
 
-        if not message.author.bot:
+        votes = self.report_votes.get(payload.message_id)
+        if votes is None:
+            votes = await self._get_report_votes(channel, payload.message_id)
+            if votes is None:
+                # The next vote counts the reactions again, including this one
+                return
+            self.report_votes[payload.message_id] = votes
+        else:
+            votes[1] += 1
+
+        repost_message_id, count = votes
+        if repost_message_id is None or count <= hash_channel["reaction_limit"]:
             return
 
-        for report_reaction in message.reactions:
-            if str(report_reaction) != "❎":
-                continue
+        # remove bot's reaction, it is not a repost
+        self.report_votes.pop(payload.message_id)
+        self.embed_cache.pop(repost_message_id)
+        try:
+            await channel.get_partial_message(repost_message_id).remove_reaction(
+                "\u267b", self.bot.user
+            )
+        except discord.errors.NotFound:
+            pass
+        except discord.errors.HTTPException as exc:
+            await bot_log.error(
+                payload.member,
+                channel,
+                "Could not delete bot reactions from message {msg_id} at guild {guild}".format(
+                    msg_id=repost_message_id, guild=payload.guild_id
+                ),
+                exception=exc,
+            )
+            return
 
-            if report_reaction.count > hash_channel.reaction_limit:
-                # remove bot's reaction, it is not a repost
+        try:
+            await channel.get_partial_message(payload.message_id).delete()
+        except discord.errors.NotFound:
+            pass
 
-                try:
-                    repost_message_id = int(
-                        message.embeds[0].footer.text.split(" | ")[1]
-                    )
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        if str(payload.emoji) != "❎":
+            return
 
-                    if repost_message_id in self.embed_cache:
-                        self.embed_cache.pop(repost_message_id)
+        votes = self.report_votes.get(payload.message_id)
+        if votes is not None and votes[0] is not None:
+            votes[1] -= 1
 
-                    repost_message = await message.channel.fetch_message(
-                        repost_message_id
-                    )
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, payload: discord.RawReactionClearEvent):
+        # The votes are counted again from the report on the next one
+        self.report_votes.pop(payload.message_id, None)
 
-                    await repost_message.remove_reaction("\u267b", self.bot.user)
-                except discord.errors.HTTPException as exc:
-                    return await bot_log.error(
-                        message.author,
-                        message,
-                        "Could not delete bot reactions from message {msg_id} at guild {guild}".format(
-                            msg_id=message.id, guild=message.guild.id
-                        ),
-                        exception=exc,
-                    )
-                return await utils.discord.delete_message(message)
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(
+        self, payload: discord.RawReactionClearEmojiEvent
+    ):
+        if str(payload.emoji) == "❎":
+            self.report_votes.pop(payload.message_id, None)
 
     # Helper functions
 
-    async def _get_attachment_hashes(self, message: discord.Message):
+    async def _download_attachment(
+        self, attachment: discord.Attachment
+    ) -> Optional[bytes]:
+        """Download attachment if it is an image small enough to be hashed.
+
+        In thumbnail mode, resized rendition is requested from the Discord
+        media proxy first. The original file is used when that fails, or when
+        the proxy returns file too large.
+
+        :raises: One of DOWNLOAD_ERRORS, if the original can't be downloaded.
+        """
+        extension = attachment.filename.split(".")[-1].lower()
+        if extension not in ALLOWED_FORMATS:
+            return None
+
+        thumbnail_url = self._get_thumbnail_url(attachment)
+        if thumbnail_url is not None:
+            try:
+                with self.stats.timer("download", source="thumbnail"):
+                    data = await self.bot.http.get_from_cdn(thumbnail_url)
+                self.stats.count("bytes_downloaded", len(data), source="thumbnail")
+                if len(data) <= MAX_ATTACHMENT_SIZE * 1024:
+                    return data
+            except DOWNLOAD_ERRORS:
+                pass
+
+        if attachment.size > MAX_ATTACHMENT_SIZE * 1024:
+            return None
+
+        with self.stats.timer("download", source="attachment"):
+            data = await attachment.read()
+        self.stats.count("bytes_downloaded", len(data), source="attachment")
+        return data
+
+    def _get_thumbnail_url(self, attachment: discord.Attachment) -> Optional[str]:
+        """Get media proxy URL of attachment resized for hashing.
+
+        :return: The URL or None, if the thumbnail would not be smaller.
+        """
+        if not self.thumbnails or not attachment.width or not attachment.height:
+            return None
+        if not re.search(DISCORD_REGEX, attachment.proxy_url):
+            return None
+
+        scale: float = REDUCED_SIZE / min(attachment.width, attachment.height)
+        if scale >= 1:
+            return None
+
+        separator: str = "&" if "?" in attachment.proxy_url else "?"
+        return "{url}{separator}width={width}&height={height}".format(
+            url=attachment.proxy_url,
+            separator=separator,
+            width=max(1, round(attachment.width * scale)),
+            height=max(1, round(attachment.height * scale)),
+        )
+
+    def _get_history_status(
+        self,
+        gtx: i18n.TranslationContext,
+        messages: int,
+        limit: Optional[int],
+        hashes: int,
+        start: float,
+    ) -> str:
+        if limit:
+            progress = _(
+                gtx,
+                "Processed **{count}** out of **{total}** messages ({percent} %).",
+            ).format(
+                count=messages,
+                total=limit,
+                percent="{:.1f}".format(messages / limit * 100),
+            )
+        else:
+            progress = _(gtx, "Processed **{messages}** messages.").format(
+                messages=messages
+            )
+
+        return (
+            _(gtx, "**SCANNING**")
+            + "\n"
+            + progress
+            + "\n"
+            + _(gtx, "Calculated **{hashes}** hashes.").format(hashes=hashes)
+            + "\n"
+            + _(gtx, "Speed **{speed}** images per second.").format(
+                speed="{:.1f}".format(hashes / (time.time() - start))
+            )
+        )
+
+    async def _hash_data(
+        self,
+        data: bytes,
+        message: Optional[discord.Message] = None,
+        commit: bool = True,
+        backfill: bool = False,
+        hash_size: int = HASH_SIZE,
+    ) -> Optional[int]:
+        """Compute image hash.
+
+        Byte-identical images are looked up by their digest first, so they
+        don't have to be decoded again.
+
+        :param message: Message with the image. The digest of new image is
+            only saved if it is known, so it can be pruned with the message.
+        :param commit: Whether to save new digest immediately.
+        :param backfill: Whether the image comes from history scan. These
+            images are hashed only when no live message is waiting.
+        :param hash_size: Size of the dhash grid.
+        :return: The hash or None, if the data could not be decoded.
+        """
+        # Digests of other hash sizes are personalized, so that the digests
+        # stored before hash size could be set stay valid
+        person: bytes = b"" if hash_size == HASH_SIZE else f"size{hash_size}".encode()
+        digest: bytes = hashlib.blake2b(
+            data, digest_size=DIGEST_SIZE, person=person
+        ).digest()
+        with self.stats.timer("database", query="digest"):
+            h = ImageDigest.get(digest)
+        if h is not None:
+            self.stats.count("cache_hits", cache="digest")
+            return h
+
+        self.stats.count("cache_misses", cache="digest")
+        h = await self.pool.hash(data, backfill=backfill, size=hash_size)
+        if h is not None and message is not None:
+            ImageDigest.add(
+                digest,
+                h,
+                message.guild.id,
+                message.channel.id,
+                message.id,
+                commit=commit,
+                bits=get_bits(hash_size),
+            )
+        return h
+
+    async def _get_history_hashes(self, message: discord.Message) -> List[dict]:
+        """Hash message attachments for ImageHash.add_bulk().
+
+        The decoding and hashing runs in the worker pool, so the event loop
+        is free to run other downloads in the meantime. The scan pauses while
+        live messages wait for the pool.
+        """
+        hash_size: int = self._get_hash_size(message.guild.id, message.channel.id)
+        rows: List[dict] = []
         for attachment in message.attachments:
-            if attachment.size > MAX_ATTACHMENT_SIZE * 1024:
+            await self.pool.wait_for_live()
+            try:
+                data = await self._download_attachment(attachment)
+            except DOWNLOAD_ERRORS:
+                continue
+            if data is None:
                 continue
 
-            extension = attachment.filename.split(".")[-1].lower()
-            if extension not in ALLOWED_FORMATS:
+            h = await self._hash_data(
+                data, message, commit=False, backfill=True, hash_size=hash_size
+            )
+            if h is None:
                 continue
 
-            fp = BytesIO()
+            rows.append(
+                {
+                    "guild_id": message.guild.id,
+                    "channel_id": message.channel.id,
+                    "message_id": message.id,
+                    "attachment_id": attachment.id,
+                    "hash": h,
+                    "bits": get_bits(hash_size),
+                }
+            )
+        return rows
 
-            await attachment.save(fp)
-            try:
-                image = Image.open(fp)
-            except OSError:
-                continue
+    async def _hash_sizes(
+        self,
+        data: bytes,
+        hash_sizes: Sequence[int],
+        message: Optional[discord.Message] = None,
+    ) -> List[Optional[int]]:
+        """Compute image hash of every size from single download.
 
-            h = dhash.dhash_int(image)
-            ImageHash.add(
-                guild_id=message.guild.id,
-                channel_id=message.channel.id,
-                message_id=message.id,
-                attachment_id=attachment.id,
-                hash=str(hex(h)),
+        :param message: Message the new digests belong to, see _hash_data().
+        """
+        return list(
+            await asyncio.gather(
+                *[
+                    self._hash_data(data, message, hash_size=hash_size)
+                    for hash_size in hash_sizes
+                ]
             )
-            yield h
+        )
 
-    async def _get_url_hashes(self, message: discord.Message):
-        for url in re.findall(URL_REGEX, message.content):
-            if not re.search(DISCORD_REGEX, url) and (
-                not self.allowed_urls or not re.search(self.allowed_urls, url)
-            ):
+    def _store_hashes(
+        self,
+        message: discord.Message,
+        attachment_id: int,
+        hash_sizes: Sequence[int],
+        hashes: List[Optional[int]],
+    ):
+        for hash_size, h in zip(hash_sizes, hashes):
+            if h is None:
                 continue
+            with self.stats.timer("database", query="store"):
+                ImageHash.add(
+                    guild_id=message.guild.id,
+                    channel_id=message.channel.id,
+                    message_id=message.id,
+                    attachment_id=attachment_id,
+                    hash=h,
+                    bits=get_bits(hash_size),
+                )
+
+    async def _get_attachment_hashes(
+        self,
+        message: discord.Message,
+        attachment: discord.Attachment,
+        save: bool,
+        hash_sizes: Sequence[int],
+    ) -> List[Optional[int]]:
+        """Hash attachment with every hash size.
+
+        :return: Hash for each of the sizes, None if there is no image.
+        """
+        data = await self._download_attachment(attachment)
+        if data is None:
+            return [None] * len(hash_sizes)
+
+        hashes = await self._hash_sizes(data, hash_sizes, message if save else None)
+        if save:
+            self._store_hashes(message, attachment.id, hash_sizes, hashes)
+        return hashes
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Get HTTP session shared by all URL downloads.
 
+        It is created on first use, because it has to be bound to the running
+        event loop.
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=HTTP_CONNECTIONS,
+                    limit_per_host=HTTP_CONNECTIONS_PER_HOST,
+                    ttl_dns_cache=HTTP_DNS_CACHE,
+                ),
+                headers=HTTP_HEADERS,
+                raise_for_status=False,
+                timeout=aiohttp.ClientTimeout(30),
+                auto_decompress=False,
+                read_bufsize=DOWNLOAD_CHUNK,
+            )
+        return self.session
+
+    async def _download_url(self, url: str) -> Optional[bytes]:
+        """Download image from URL.
+
+        The body is read in chunks and the download is aborted as soon as it
+        exceeds MAX_ATTACHMENT_SIZE, so responses without content-length
+        can be accepted as well.
+
+        :return: The image data or None, if the URL does not point to image.
+        :raises aiohttp.ClientError: If the download failed, also when the
+            server is rate limiting or down, which may be only temporary.
+        """
+        max_size: int = MAX_ATTACHMENT_SIZE * 1024
+        data = bytearray()
+        try:
+            with self.stats.timer("download", source="url"):
+                async with self._get_session().get(url) as resp:
+                    if resp.status == 429 or resp.status >= 500:
+                        resp.raise_for_status()
+                    if resp.status != 200:
+                        return None
+                    size = resp.headers.get("content-length")
+                    if size is not None and int(size) > max_size:
+                        return None
+
+                    type = resp.headers.get("content-type", "")
+                    type = type.split(";")[0].split("/")
+                    if (
+                        len(type) != 2
+                        or type[0] != "image"
+                        or type[1] not in ALLOWED_FORMATS
+                    ):
+                        return None
+
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK):
+                        data.extend(chunk)
+                        if len(data) > max_size:
+                            return None
+                    return bytes(data)
+        finally:
+            self.stats.count("bytes_downloaded", len(data), source="url")
+
+    def _get_urls(self, message: discord.Message) -> List[str]:
+        """Get URLs in message content which should be hashed."""
+        return [
+            url
+            for url in re.findall(URL_REGEX, message.content)
+            if re.search(DISCORD_REGEX, url)
+            or (self.allowed_urls and re.search(self.allowed_urls, url))
+        ]
+
+    async def _get_url_hashes(
+        self, message: discord.Message, url: str, save: bool, hash_sizes: Sequence[int]
+    ) -> List[Optional[int]]:
+        """Hash image at URL with every hash size.
+
+        The URL is downloaded at most once, only when some of the hashes are
+        not cached.
+
+        :return: Hash for each of the sizes, None if there is no image.
+        """
+        hashes: Dict[int, Optional[int]] = {}
+        for hash_size in hash_sizes:
+            if (hash_size, url) in self.url_cache:
+                hashes[hash_size] = self.url_cache[(hash_size, url)]
+        self.stats.count("cache_hits", len(hashes), cache="url")
+
+        missing = [hash_size for hash_size in hash_sizes if hash_size not in hashes]
+        if missing:
+            self.stats.count("cache_misses", len(missing), cache="url")
             try:
-                async with aiohttp.ClientSession(
-                    headers=HTTP_HEADERS,
-                    raise_for_status=False,
-                    timeout=aiohttp.ClientTimeout(30),
-                    auto_decompress=False,
-                    read_bufsize=256,
-                ) as session:
-                    async with session.get(url, read_until_eof=False) as resp:
-                        if resp.status != 200:
-                            continue
-                        size = resp.headers.get("content-length")
-                        if not size or int(size) > MAX_ATTACHMENT_SIZE * 1024:
-                            continue
-
-                        type = resp.headers.get("content-type").split("/")
-                        if (
-                            len(type) != 2
-                            or type[0] != "image"
-                            or type[1] not in ALLOWED_FORMATS
-                        ):
-                            continue
-
-                        image = Image.open(BytesIO(await resp.read()))
-
-                        h = dhash.dhash_int(image)
-                        ImageHash.add(
-                            guild_id=message.guild.id,
-                            channel_id=message.channel.id,
-                            message_id=message.id,
-                            attachment_id=0,
-                            hash=str(hex(h)),
-                        )
-                        yield h
-            except aiohttp.ClientError:
-                continue
+                data = await self._download_url(url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                # The server may be down only temporarily
+                for hash_size in missing:
+                    self.url_cache.set((hash_size, url), None, ttl=URL_ERROR_TTL)
+                return [None] * len(hash_sizes)
+
+            if data is not None:
+                computed = await self._hash_sizes(
+                    data, missing, message if save else None
+                )
+            else:
+                computed = [None] * len(missing)
+            for hash_size, h in zip(missing, computed):
+                hashes[hash_size] = self.url_cache[(hash_size, url)] = h
+
+        result = [hashes[hash_size] for hash_size in hash_sizes]
+        if save:
+            self._store_hashes(message, 0, hash_sizes, result)
+        return result
+
+    async def _get_message_hashes(
+        self,
+        message: discord.Message,
+        save: bool = True,
+        hash_sizes: Sequence[int] = (HASH_SIZE,),
+    ) -> Dict[int, List[int]]:
+        """Hash all images of message.
+
+        All images are downloaded and hashed at once, so the message waits
+        only for the slowest of them. Each image is downloaded once and
+        hashed with all the sizes.
+
+        :param save: Whether to store the hashes.
+        :param hash_sizes: Sizes of the dhash grid.
+        :return: Image hashes by the hash size.
+        """
+        semaphore = asyncio.Semaphore(MESSAGE_IMAGES)
+
+        async def limited(job):
+            async with semaphore:
+                return await job
+
+        jobs = [
+            self._get_attachment_hashes(message, attachment, save, hash_sizes)
+            for attachment in message.attachments
+        ] + [
+            self._get_url_hashes(message, url, save, hash_sizes)
+            for url in self._get_urls(message)
+        ]
+        images = await asyncio.gather(*[limited(job) for job in jobs])
+        return {
+            hash_size: [hashes[i] for hashes in images if hashes[i] is not None]
+            for i, hash_size in enumerate(hash_sizes)
+        }
 
     async def _check_message(self, message: discord.Message):
         """Check if message contains duplicate image."""
-        attachments = [x async for x in self._get_attachment_hashes(message)]
-        urls = [x async for x in self._get_url_hashes(message)]
-        image_hashes = attachments + urls
+        hash_size: int = self._get_hash_size(message.guild.id, message.channel.id)
+        bits: int = get_bits(hash_size)
+        image_hashes = (
+            await self._get_message_hashes(message, hash_sizes=(hash_size,))
+        )[hash_size]
 
         duplicates = {}
-        all_images = None
-
-        for image_hash in image_hashes:
-            # try to look up hash directly
-            images = ImageHash.get_hash(
-                message.guild.id, message.channel.id, str(hex(image_hash))
-            )
-            duplicated = False
-
-            for image in images:
-                # skip current message
-                if image.message_id == message.id:
-                    continue
-                # add to duplicates
-                duplicates[image] = 0
-                duplicated = True
+        channel_ids = self._get_scope_channel_ids(message.guild.id, message.channel.id)
+        index = await self._get_index(message.guild.id, bits)
+        with self.stats.timer("index"):
+            for image_hash in image_hashes:
+                # only hashes closer than LIMIT_SOFT are returned by the index
+                result = index.nearest(
+                    image_hash, exclude_message_id=message.id, channel_ids=channel_ids
+                )
+                if result is not None:
+                    duplicate, distance = result
+                    duplicates[duplicate] = distance
+
+        if not duplicates:
+            return
+
+        await message.add_reaction("♻")
+        await asyncio.gather(
+            *[
+                self._report_duplicate(message, image_hash, distance, bits)
+                for image_hash, distance in duplicates.items()
+            ]
+        )
+
+    async def _prune_channel(
+        self, guild_id: int, channel_id: int, before_message_id: Optional[int] = None
+    ) -> int:
+        """Delete channel hashes, digests and reports in batches.
+
+        Other tasks can run between the batches, so large channels don't
+        block the bot.
+
+        :param before_message_id: Only delete data of older messages. All
+            data of the channel is deleted if None.
+        :return: Number of deleted hashes.
+        """
+        deleted: int = 0
+        while True:
+            count = ImageHash.prune(
+                guild_id, channel_id, before_message_id, PRUNE_BATCH
+            )
+            deleted += count
+            if count < PRUNE_BATCH:
                 break
+            await asyncio.sleep(0)
 
-            # move on to the next hash
-            if duplicated:
-                continue
+        while (
+            ImageDigest.prune(guild_id, channel_id, before_message_id, PRUNE_BATCH)
+            == PRUNE_BATCH
+        ):
+            await asyncio.sleep(0)
+
+        while True:
+            reports = RepostReport.prune(
+                guild_id, channel_id, before_message_id, PRUNE_BATCH
+            )
+            for report in reports:
+                self.report_votes.pop(report.report_id, None)
+                self.embed_cache.pop(report.message_id, None)
+            if len(reports) < PRUNE_BATCH:
+                return deleted
+            await asyncio.sleep(0)
+
+    def _get_scope_channel_ids(self, guild_id: int, channel_id: int) -> List[int]:
+        """Get channels searched for reposts of images from given channel.
 
-            # full match not found, iterate over whole database
-            if all_images is None:
-                all_images = ImageHash.get_by_channel(
-                    message.guild.id, message.channel.id
+        Only channels with the same hash size can be compared.
+        """
+        hash_channel = self.hash_channels[(guild_id, channel_id)]
+        if hash_channel["scope"] != "guild":
+            return [channel_id]
+        return [
+            c_id
+            for (g_id, c_id), other in self.hash_channels.items()
+            if g_id == guild_id and other["hash_size"] == hash_channel["hash_size"]
+        ]
+
+    def _export_stats(self) -> str:
+        """Get statistics together with the current pool, cache and index sizes."""
+        caches = {
+            "embed": self.embed_cache,
+            "report_votes": self.report_votes,
+            "original": self.original_cache,
+            "url": self.url_cache,
+        }
+        gauges = {
+            "index_hashes": {
+                (
+                    ("bits", str(bits)),
+                    ("channel_id", str(channel_id)),
+                    ("guild_id", str(guild_id)),
+                ): count
+                for (guild_id, channel_id, bits), count in (
+                    ImageHash.get_index_sizes().items()
                 )
+            },
+            "pool_running": {(): self.pool.running},
+            "pool_waiting": {(): self.pool.waiting},
+            "cache_entries": {
+                (("cache", name),): len(cache) for name, cache in caches.items()
+            },
+            "cache_memory_bytes": {
+                (("cache", name),): cache.memory_usage()
+                for name, cache in caches.items()
+            },
+        }
+        return self.stats.export(gauges)
+
+    def _drop_unused_indexes(self, guild_id: int):
+        """Forget indices and snapshots of sizes no guild channel uses."""
+        ImageHash.drop_indexes(
+            guild_id,
+            {
+                get_bits(hash_channel["hash_size"])
+                for (channel_guild_id, _), hash_channel in self.hash_channels.items()
+                if channel_guild_id == guild_id
+            },
+        )
+
+    def _get_hash_size(self, guild_id: int, channel_id: int) -> int:
+        """Get hash size of channel. Other channels use the default one."""
+        hash_channel = self.hash_channels.get((guild_id, channel_id))
+        return hash_channel["hash_size"] if hash_channel else HASH_SIZE
 
-            minimal_distance = 128
-            duplicate = None
-            for image in all_images:
-                # skip current image
-                if image.message_id == message.id:
-                    continue
+    async def _get_index(self, guild_id: int, bits: int) -> HashIndex:
+        """Get index of guild hashes of given size.
 
-                # do the comparison
-                db_image_hash = int(image.hash, 16)
-                distance = dhash.get_num_bits_different(db_image_hash, image_hash)
-                if distance < minimal_distance:
-                    duplicate = image
-                    minimal_distance = distance
+        The index is loaded in a thread, so the bot keeps responding. Callers
+        wait for the load in progress instead of starting another one.
 
-            if minimal_distance < LIMIT_SOFT:
-                duplicates[duplicate] = minimal_distance
+        The index returns hashes closer than LIMIT_SOFT, scaled to the size.
+        """
+        radius: int = scale_limit(LIMIT_SOFT, bits) - 1
+        if ImageHash.is_index_loaded(guild_id, bits):
+            return ImageHash.get_index(guild_id, radius=radius, bits=bits)
+
+        load = self.index_loads.get((guild_id, bits))
+        if load is None:
+            load = asyncio.create_task(self._load_index(guild_id, bits, radius))
+            self.index_loads[(guild_id, bits)] = load
+        # One cancelled caller must not cancel the load for the others
+        return await asyncio.shield(load)
+
+    async def _load_index(self, guild_id: int, bits: int, radius: int) -> HashIndex:
+        index: Optional[HashIndex] = None
+        ImageHash.begin_load(guild_id, bits)
+        try:
+            with self.stats.timer("index_load"):
+                index = await asyncio.to_thread(
+                    ImageHash.load_index, guild_id, radius, bits
+                )
+        finally:
+            ImageHash.finish_load(guild_id, bits, index)
+            del self.index_loads[(guild_id, bits)]
+        return ImageHash.get_index(guild_id, radius=radius, bits=bits)
+
+    async def _warm_up_indexes(self):
+        """Load indices of all hash channels, before the first images come."""
+        keys = {
+            (guild_id, get_bits(hash_channel["hash_size"]))
+            for (guild_id, _), hash_channel in self.hash_channels.items()
+        }
+        for guild_id, bits in sorted(keys):
+            try:
+                await self._get_index(guild_id, bits)
+            except Exception as exc:
+                await bot_log.error(
+                    self.bot.user,
+                    None,
+                    f"Could not load dhash index of guild {guild_id}.",
+                    exception=exc,
+                )
+
+    async def _get_report_votes(
+        self, channel: discord.TextChannel, message_id: int
+    ) -> Optional[List[Optional[int]]]:
+        """Count 'This is not a repost' votes of report.
+
+        :return: List of repost message ID and the vote count. The ID is None
+            if the message is not a report. None if the report could not be
+            fetched right now, so the votes have to be counted again later.
+        """
+        report = RepostReport.get_by_report(channel.guild.id, message_id)
+        if report is not None:
+            repost_message_id = report.message_id
+        else:
+            repost_message_id = None
+
+        try:
+            message = await channel.fetch_message(message_id)
+        except discord.errors.NotFound:
+            return [None, 0]
+        except discord.errors.HTTPException:
+            return None
+
+        if repost_message_id is None:
+            # Reports sent before they were stored in the database have the
+            # reposter's user ID and repost message ID in the footer
+            if message.author != self.bot.user or len(message.embeds) != 1:
+                return [None, 0]
+            footer = message.embeds[0].footer.text or ""
+            try:
+                repost_message_id = int(footer.split(" | ")[1])
+            except (IndexError, ValueError):
+                return [None, 0]
 
-        for image_hash, distance in duplicates.items():
-            await self._report_duplicate(message, image_hash, distance)
+        for reaction in message.reactions:
+            if str(reaction) == "❎":
+                return [repost_message_id, reaction.count]
+        return [repost_message_id, 0]
+
+    async def _delete_reports(self, guild_id: int, message_ids: List[int]):
+        """Delete repost reports of deleted messages.
+
+        The reports are looked up in the cache first, then in the database.
+        """
+        reports = RepostReport.remove_bulk(guild_id, message_ids)
+        targets: List[Tuple[int, int]] = []
+        for message_id in message_ids:
+            self.report_votes.pop(message_id)
+            cached = self.embed_cache.pop(message_id, None)
+            if cached is None:
+                cached = [
+                    (report.channel_id, report.report_id)
+                    for report in reports
+                    if report.message_id == message_id
+                ]
+            targets += cached
+
+        # Reports deleted together with the reposts don't exist anymore
+        deleted = set(message_ids)
+        targets = [target for target in targets if target[1] not in deleted]
+
+        guild = self.bot.get_guild(guild_id)
+        for channel_id, report_id in targets:
+            channel = guild.get_channel(channel_id)
+            if channel is None:
+                continue
+            try:
+                await channel.get_partial_message(report_id).delete()
+            except discord.errors.NotFound:
+                pass
+            except discord.errors.HTTPException as exc:
+                await bot_log.error(
+                    self.bot.user,
+                    channel,
+                    f"Could not delete repost embed {report_id} at guild {guild_id}.",
+                    exception=exc,
+                )
+
+    async def _get_original(
+        self, guild: discord.Guild, original: IndexEntry
+    ) -> Optional[Tuple[str, str]]:
+        """Get author name and jump URL of the original message.
+
+        In guild scope, the original may be in channel the bot can't see, or
+        which does not exist anymore.
+
+        :return: The tuple or None, if the message is not available.
+        """
+        if original.message_id in self.original_cache:
+            self.stats.count("cache_hits", cache="original")
+            return self.original_cache[original.message_id]
+
+        self.stats.count("cache_misses", cache="original")
+        channel = guild.get_channel(original.channel_id)
+        if channel is None:
+            return None
+        try:
+            with self.stats.timer("discord", request="original"):
+                message = await channel.fetch_message(original.message_id)
+        except discord.errors.NotFound:
+            self.original_cache[original.message_id] = None
+            return None
+        except discord.errors.HTTPException:
+            # Missing permissions or temporary error, don't remember it
+            return None
+        result = (
+            discord.utils.escape_markdown(message.author.display_name),
+            message.jump_url,
+        )
+        self.original_cache[original.message_id] = result
+        return result
 
     async def _report_duplicate(
-        self, message: discord.Message, original: ImageHash, distance: int
+        self,
+        message: discord.Message,
+        original: IndexEntry,
+        distance: int,
+        bits: int = HASH_BITS,
     ):
         """Send report.
         message: The new message containing attachment repost.
         original: The original attachment.
         distance: Hamming distance between the original and repost.
+        bits: Size of the hashes.
         """
         gtx = i18n.TranslationContext(message.guild.id, None)
 
-        if distance <= LIMIT_FULL:
+        if distance <= scale_limit(LIMIT_FULL, bits):
             level = _(gtx, "**♻ This is repost!**")
-        elif distance <= LIMIT_HARD:
+        elif distance <= scale_limit(LIMIT_HARD, bits):
             level = _(gtx, "**♻ This is probably repost!**")
         else:
             level = _(gtx, "🤷🏻 This could be repost.")
 
-        await message.add_reaction("♻")
-
-        similarity = "{:.1f} %".format((1 - distance / 128) * 100)
+        similarity = "{:.1f} %".format((1 - distance / bits) * 100)
         timestamp = utils.time.id_to_datetime(original.message_id).strftime(
             "%Y-%m-%d %H:%M:%S"
         )
 
-        try:
-            original_channel = message.guild.get_channel(original.channel_id)
-            original_message = await original_channel.fetch_message(original.message_id)
-            author = discord.utils.escape_markdown(original_message.author.display_name)
-            link = f"[**{author}**, {timestamp}]({original_message.jump_url})"
-        except discord.errors.NotFound:
+        original_message = await self._get_original(message.guild, original)
+        if original_message is not None:
+            author, jump_url = original_message
+            link = f"[**{author}**, {timestamp}]({jump_url})"
+        else:
             link = "404 😿"
 
         description = _(gtx, "{name}, matching **{similarity}**!").format(
@@ -621,17 +1879,22 @@ class Dhash(commands.Cog):
                 "If it's not, click here on ❎ and when we reach {limit} reactions, "
                 "this message will be deleted._",
             ).format(
-                limit=HashChannel.get(
-                    message.guild.id, message.channel.id
-                ).reaction_limit,
+                limit=self.hash_channels[(message.guild.id, message.channel.id)][
+                    "reaction_limit"
+                ],
             ),
             inline=False,
         )
         embed.set_footer(text=f"{message.author.id} | {message.id}")
 
-        report = await message.reply(embed=embed)
+        with self.stats.timer("discord", request="report"):
+            report = await message.reply(embed=embed)
+        self.stats.count("reports")
 
-        self.embed_cache[message.id] = report
+        RepostReport.add(message.guild.id, report.channel.id, message.id, report.id)
+        self.embed_cache[message.id] = self.embed_cache.get(message.id, ()) + (
+            (report.channel.id, report.id),
+        )
 
         await report.add_reaction("❎")
 
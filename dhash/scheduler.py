@@ -0,0 +1,108 @@
+"""
+Scheduling of hashing jobs from live messages and from history backfill.
+"""
+
+import asyncio
+from collections import deque
+from typing import Deque, Dict
+
+LIVE = "live"
+BACKFILL = "backfill"
+LANES = (LIVE, BACKFILL)
+
+
+class PrioritySlots:
+    """Semaphore with a high-priority lane for live messages and a low-priority
+    lane for backfill.
+
+    Waiting live jobs are always started before waiting backfill jobs, and
+    backfill can hold at most ``backfill_size`` slots, so that live jobs
+    arriving during a backfill find a free slot right away.
+    """
+
+    def __init__(self, size: int, backfill_size: int):
+        self.size: int = size
+        self.backfill_size: int = min(backfill_size, size)
+
+        self._running: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {
+            lane: deque() for lane in LANES
+        }
+        self._no_backlog = asyncio.Event()
+        self._no_backlog.set()
+
+    @property
+    def running(self) -> int:
+        return sum(self._running.values())
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def waiting_in(self, lane: str) -> int:
+        return len(self._waiters[lane])
+
+    @property
+    def backlog(self) -> bool:
+        """Whether there are live jobs waiting for a slot."""
+        return bool(self._waiters[LIVE])
+
+    def _can_start(self, lane: str) -> bool:
+        if self.running >= self.size:
+            return False
+        return lane == LIVE or self._running[BACKFILL] < self.backfill_size
+
+    async def acquire(self, lane: str = LIVE):
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane '{lane}'.")
+
+        if not self._waiters[LIVE] and self._can_start(lane):
+            if lane == LIVE or not self._waiters[BACKFILL]:
+                self._running[lane] += 1
+                return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(future)
+        self._update()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was given to us just before the cancellation
+                self.release(lane)
+            else:
+                self._waiters[lane].remove(future)
+                self._update()
+            raise
+
+    def release(self, lane: str = LIVE):
+        self._running[lane] -= 1
+        self._wake()
+
+    def _wake(self):
+        for lane in LANES:
+            waiters = self._waiters[lane]
+            while waiters and self._can_start(lane):
+                future = waiters.popleft()
+                if future.done():
+                    continue
+                self._running[lane] += 1
+                future.set_result(None)
+            if waiters:
+                # Backfill never overtakes waiting live jobs
+                break
+        self._update()
+
+    def _update(self):
+        if self.backlog:
+            self._no_backlog.clear()
+        else:
+            self._no_backlog.set()
+
+    async def wait_for_live(self):
+        """Wait until there are no live jobs waiting for a slot.
+
+        Backfill calls this before starting new work, e.g. downloads, so that
+        it does not compete with live messages for the network either.
+        """
+        await self._no_backlog.wait()
@@ -0,0 +1,184 @@
+"""
+Timing histograms and counters of image processing stages.
+
+The values are kept in memory only. They can be shown in Discord or exported
+in Prometheus text format, see Stats.export().
+"""
+
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+BUCKETS: Tuple[float, ...] = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+"""Upper bounds of histogram buckets, in seconds."""
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Distribution of durations in fixed buckets."""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets: Tuple[float, ...] = buckets
+        # The last bucket holds values over the largest bound
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Estimate quantile by linear interpolation inside its bucket.
+
+        The estimate never exceeds the largest observed value.
+        """
+        if not self.count:
+            return 0.0
+        rank: float = q * self.count
+        seen: int = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                value = lower + (upper - lower) * (rank - seen) / count
+                return min(value, self.max)
+            seen += count
+        return self.max
+
+    def cumulative(self) -> Iterator[Tuple[str, int]]:
+        """Get bucket bounds with counts of values up to them."""
+        total: int = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield _format_value(bound), total
+        yield "+Inf", self.count
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Stats:
+    """Timings of processing stages and event counters.
+
+    Stages are timed by ``with stats.timer("download"):``, counters are
+    increased by ``stats.count("images_hashed")``. Both accept labels, e.g.
+    the cache name.
+    """
+
+    def __init__(self, prefix: str = "dhash", clock=time.perf_counter):
+        self.prefix: str = prefix
+        self.clock = clock
+        self.started: float = time.time()
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, object]) -> Tuple[str, Labels]:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, stage: str, seconds: float, **labels):
+        key = self._key(stage, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str, **labels) -> Iterator[None]:
+        """Measure duration of the block, including failed ones."""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.observe(stage, self.clock() - start, **labels)
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def get_count(self, name: str, **labels) -> float:
+        return self.counters.get(self._key(name, labels), 0)
+
+    def get_histogram(self, stage: str, **labels) -> Optional[Histogram]:
+        return self.histograms.get(self._key(stage, labels))
+
+    def reset(self):
+        self.started = time.time()
+        self.histograms.clear()
+        self.counters.clear()
+
+    def export(self, gauges: Optional[Dict[str, Dict[Labels, float]]] = None) -> str:
+        """Get all values in Prometheus text exposition format.
+
+        :param gauges: Current values which are not tracked by this object,
+            e.g. the index sizes, by their name and labels.
+        """
+        lines: List[str] = []
+
+        name = f"{self.prefix}_stage_seconds"
+        lines.append(f"# HELP {name} Duration of image processing stages.")
+        lines.append(f"# TYPE {name} histogram")
+        for (stage, labels), histogram in sorted(self.histograms.items()):
+            labels = (("stage", stage),) + labels
+            for bound, count in histogram.cumulative():
+                lines.append(
+                    f"{name}_bucket{_format_labels(labels, (('le', bound),))} {count}"
+                )
+            lines.append(
+                f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}"
+            )
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        counters: Dict[str, List[Tuple[Labels, float]]] = {}
+        for (counter, labels), value in sorted(self.counters.items()):
+            counters.setdefault(counter, []).append((labels, value))
+        for counter, values in counters.items():
+            name = f"{self.prefix}_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in values:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for gauge, values in sorted((gauges or {}).items()):
+            name = f"{self.prefix}_{gauge}"
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"